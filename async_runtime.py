@@ -0,0 +1,249 @@
+import asyncio
+import logging
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from typing import List, Optional
+
+from functools import partial
+
+from dsmr_parser.clients.protocol import DSMRProtocol
+from dsmr_parser.exceptions import InvalidChecksumError, ParseError
+from serial_asyncio import create_serial_connection
+
+from domoticz_pusher import DomoticzPusher
+from energyportalsender import EnergyPortalSender
+from enums import SendResult
+from mocker import Mocker
+from mqtt_publisher import MqttPublisher
+from read_handler_interface import ReadHandlerInterface
+from reader import Reader
+from replay_reader import ReplayReader
+
+
+class AsyncSink(ReadHandlerInterface):
+    """Read handler that hands readings over to a coroutine on the event loop."""
+
+    def __init__(self, name: str, max_size: int):
+        self.name = name
+        self.queue: asyncio.Queue = asyncio.Queue(maxsize=max_size)
+
+    def handle_read(self, data: dict) -> None:
+        # Drop the oldest reading when the sink cannot keep up, the reader must never wait on a sink
+        if self.queue.full():
+            self.queue.get_nowait()
+
+        self.queue.put_nowait(data)
+
+    def get_name(self) -> str:
+        return self.name
+
+
+class AsyncRuntime:
+    """Runs the reader and all sinks as coroutines on a single event loop.
+
+    Telegrams are read with the asyncio protocol of dsmr_parser. The sinks keep using their blocking clients
+    (requests, redis, paho), but those calls are executed on one small shared thread pool, so the number of threads
+    no longer grows with the number of configured portals and MQTT brokers."""
+
+    def __init__(self, config: dict, stop_event: threading.Event, logger: logging.Logger,
+                 readers: List[Reader or Mocker], redis_pusher: ReadHandlerInterface,
+                 domoticz_pusher: Optional[DomoticzPusher], mqtt_publishers: List[MqttPublisher],
+                 senders: List[EnergyPortalSender]):
+        self.stop_event = stop_event
+        self.logger = logger
+        self.readers = readers
+        self.redis_pusher = redis_pusher
+        self.domoticz_pusher = domoticz_pusher
+        self.mqtt_publishers = mqtt_publishers
+        self.senders = senders
+        self.max_queue_size = config.get('async_queue_size', 100)
+        self.executor = ThreadPoolExecutor(max_workers=config.get('async_workers', 4),
+                                           thread_name_prefix='energy-reader-io')
+
+    def run(self):
+        try:
+            asyncio.run(self.main())
+        finally:
+            self.executor.shutdown(wait=False)
+
+    async def main(self):
+        tasks = [asyncio.create_task(self.wait_for_stop())]
+        sinks: List[ReadHandlerInterface] = []
+
+        redis_sink = AsyncSink(self.redis_pusher.get_name(), self.max_queue_size)
+        sinks.append(redis_sink)
+        tasks.append(asyncio.create_task(self.run_redis_pusher(redis_sink)))
+
+        if self.domoticz_pusher is not None:
+            domoticz_sink = AsyncSink(self.domoticz_pusher.get_name(), self.max_queue_size)
+            sinks.append(domoticz_sink)
+            tasks.append(asyncio.create_task(self.run_domoticz_pusher(domoticz_sink)))
+
+        for publisher in self.mqtt_publishers:
+            mqtt_sink = AsyncSink(publisher.get_name(), self.max_queue_size)
+            sinks.append(mqtt_sink)
+            tasks.append(asyncio.create_task(self.run_mqtt_publisher(publisher, mqtt_sink)))
+
+        for sender in self.senders:
+            for worker in range(sender.workers):
+                tasks.append(asyncio.create_task(self.run_sender(sender, worker)))
+
+        for reader in self.readers:
+            reader.read_handlers = sinks
+
+            if isinstance(reader, Mocker):
+                tasks.append(asyncio.create_task(self.run_mocker(reader)))
+            elif isinstance(reader, ReplayReader):
+                tasks.append(asyncio.create_task(self.run_replay(reader)))
+            else:
+                tasks.append(asyncio.create_task(self.run_reader(reader)))
+
+        # Any task that ends, ends the application, just like a dead thread does in threaded mode
+        done, pending = await asyncio.wait(tasks, return_when=asyncio.FIRST_COMPLETED)
+
+        for task in done:
+            if not task.cancelled() and task.exception() is not None:
+                self.logger.error('Task failed, exit application', exc_info=task.exception())
+
+        for task in pending:
+            task.cancel()
+
+        await asyncio.gather(*pending, return_exceptions=True)
+
+        # The threaded pusher saves the last known values when it stops, the coroutine has to do it here
+        if self.domoticz_pusher is not None:
+            try:
+                await self.run_blocking(self.domoticz_pusher.last_known_values.flush)
+            except Exception as e:
+                self.logger.error('Failed to save the last known Domoticz values', exc_info=e)
+
+        self.logger.info('Event loop has been stopped')
+
+    async def run_blocking(self, func, *args):
+        return await asyncio.get_running_loop().run_in_executor(self.executor, func, *args)
+
+    async def wait_for_stop(self):
+        while not self.stop_event.is_set():
+            await asyncio.sleep(0.2)
+
+    async def run_reader(self, reader: Reader):
+        reader.logger.info(f'Reader of {reader.device} has been started')
+
+        if reader.solar_poller is not None:
+            reader.solar_poller.start()
+
+        loop = asyncio.get_running_loop()
+
+        # The protocol of dsmr_parser buffers the telegrams, the reader takes the place of its parser so the telegrams
+        # are captured and parsed the same way as in threaded mode
+        serial_settings, _ = Reader.DSMR_VERSIONS[reader.dsmr_version]
+        protocol_factory = partial(DSMRProtocol, loop, reader, telegram_callback=reader.handle_values)
+        connection = create_serial_connection(loop, protocol_factory, **dict(serial_settings, url=reader.device))
+        transport, protocol = await connection
+
+        try:
+            await protocol.wait_closed()
+        finally:
+            transport.close()
+
+            if reader.capture is not None:
+                reader.capture.close()
+
+            reader.logger.info(f'Reader of {reader.device} has been stopped')
+
+    async def run_replay(self, reader: ReplayReader):
+        reader.logger.info(f'Replaying {len(reader.files)} capture file(s) at speed {reader.speed}')
+
+        for received, telegram in reader.replay():
+            # Unlike live telegrams, replayed telegrams can wait until the sinks have room
+            while any(sink.queue.full() for sink in reader.read_handlers):
+                await asyncio.sleep(0.01)
+
+            await asyncio.sleep(max(reader.get_delay(received), 0))
+
+            try:
+                values = reader.parse(telegram, received)
+            except (InvalidChecksumError, ParseError) as e:
+                reader.logger.warning(f'Failed to parse telegram: {e}')
+                continue
+
+            reader.handle_values(values, received)
+
+        reader.logger.info('Replay has finished')
+
+        # Keep running until the application stops, so the sinks can deliver the replayed readings
+        await asyncio.Event().wait()
+
+    async def run_mocker(self, reader: Mocker):
+        self.logger.info(f'Mock reader has been started, generating {reader.rate} reading(s) per second for '
+                         f'{len(reader.meters)} meter(s)')
+
+        while True:
+            delay = reader.get_delay()
+
+            # Always yield to the sinks, even when the mocker is behind at high rates
+            await asyncio.sleep(max(delay, 0))
+
+            if delay <= 0:
+                reader.emit()
+
+    async def run_redis_pusher(self, sink: AsyncSink):
+        while True:
+            data = await sink.queue.get()
+            await self.run_blocking(self.redis_pusher.handle_read, data)
+
+    async def run_domoticz_pusher(self, sink: AsyncSink):
+        while True:
+            data = await sink.queue.get()
+
+            while not await self.is_connected(self.domoticz_pusher):
+                await asyncio.sleep(10)
+
+            await self.run_blocking(self.domoticz_pusher.push_reading, data)
+
+    async def run_mqtt_publisher(self, publisher: MqttPublisher, sink: AsyncSink):
+        while True:
+            data = await sink.queue.get()
+
+            while not await self.is_connected(publisher):
+                await asyncio.sleep(5)
+
+            if publisher.is_throttled(data):
+                continue
+
+            await self.run_blocking(publisher.publish_reading, data)
+
+    async def run_sender(self, sender: EnergyPortalSender, worker: int):
+        sender.logger.info('Sender has been started')
+
+        while not sender.stop_event.is_set():
+            try:
+                # The backlog grows while the portal cannot be reached, so it is managed before connecting
+                await self.run_blocking(sender.manage_backlog)
+
+                if not sender.connected:
+                    await self.run_blocking(sender.connect_to_api)
+
+                if not sender.connected:
+                    await asyncio.sleep(5)
+                    continue
+
+                # Blocking waits would tie up the shared thread pool, so poll while idle instead
+                result = await self.run_blocking(partial(sender.send_next_batch, worker=worker))
+
+                if result == SendResult.EMPTY:
+                    await asyncio.sleep(1)
+                elif result == SendResult.FAILED:
+                    await asyncio.sleep(sender.get_retry_delay())
+            except Exception as e:
+                sender.logger.error('Failed to send data', exc_info=e)
+                await asyncio.sleep(5)
+
+        sender.logger.info('Sender has been terminated')
+
+    async def is_connected(self, sink) -> bool:
+        try:
+            return await self.run_blocking(sink.is_connected)
+        except Exception as e:
+            self.logger.error(f'Failed to connect {sink.get_name()}', exc_info=e)
+            return False
@@ -0,0 +1,138 @@
+import datetime
+import json
+import logging
+import threading
+import time
+from typing import List
+
+import reading_codec
+
+INSTANTANEOUS_FIELDS = ['usageNow', 'redeliveryNow', 'solarNow', 'usageGasNow']
+
+
+class BacklogManager:
+    """Keeps the backlog of a portal queue bounded by rolling old readings up into coarser buckets.
+
+    Every tier is an [age, bucket] pair: readings older than age seconds are merged per bucket seconds. A merged
+    reading carries the cumulative counters of the last reading in its bucket, so totals stay exact, and the mean of
+    the instantaneous power weighted by the number of readings it replaces, which it stores as samples. Readings of
+    different meters are never merged. When the queue is larger than max_size, the tiers are applied regardless of
+    age."""
+
+    def __init__(self, queue, config: dict, logger: logging.Logger):
+        self.queue = queue
+        self.logger = logger
+        self.min_size = config.get('min_size', 360)
+        self.max_size = config.get('max_size', 8640)
+        self.tiers = sorted(config.get('tiers', [[3600, 60], [86400, 900]]))
+        self.check_interval = config.get('check_interval', 300)
+        self.chunk_size = config.get('chunk_size', 10000)
+        self.lock = threading.Lock()
+        self.last_check = time.time()
+
+    def run_if_due(self):
+        if time.time() - self.last_check < self.check_interval:
+            return
+
+        # Only one worker compacts at a time
+        if not self.lock.acquire(blocking=False):
+            return
+
+        try:
+            self.last_check = time.time()
+            self.compact()
+        except Exception as e:
+            self.logger.error(f'Failed to compact backlog of {self.queue.key}', exc_info=e)
+        finally:
+            self.lock.release()
+
+    def compact(self):
+        size = self.queue.qsize()
+
+        if size < self.min_size:
+            return
+
+        forced_tier = None
+
+        if size > 2 * self.max_size:
+            forced_tier = len(self.tiers) - 1
+        elif size > self.max_size:
+            forced_tier = 0
+
+        # The chunk stays on the queue while it is compacted, so a crash or an error cannot lose it
+        messages = self.queue.peek_many(self.chunk_size)
+        compacted = self.downsample(messages, forced_tier)
+
+        if len(compacted) == len(messages):
+            return
+
+        if not self.queue.replace_head(messages, compacted):
+            self.logger.info(f'Backlog of {self.queue.key} was read while it was compacted, trying again later')
+            return
+
+        self.logger.info(f'Rolled {len(messages)} queued reading(s) of {self.queue.key} up into {len(compacted)}')
+
+    def downsample(self, messages: List[bytes], forced_tier=None) -> List[bytes]:
+        now = time.time()
+        # The readings of several meters can be interleaved, so every meter and bucket has a group of its own. A group
+        # takes the place of its first reading, which keeps the order of the readings of every meter.
+        groups = []
+        open_groups = {}
+
+        for message in messages:
+            try:
+                reading = json.loads(reading_codec.decode(message))
+                created = datetime.datetime.fromisoformat(reading['created']).timestamp()
+            except Exception as e:
+                # Messages that cannot be decoded are kept as they are, the portal decides what to do with them
+                self.logger.warning(f'Could not decode queued reading of {self.queue.key}, keeping it', exc_info=e)
+                reading = None
+                created = now
+
+            bucket = None if reading is None else self.get_bucket(now - created, forced_tier)
+
+            if bucket is None:
+                groups.append([(message, reading)])
+                continue
+
+            key = (reading.get('meterId'), bucket, int(created // bucket))
+
+            if key not in open_groups:
+                open_groups[key] = []
+                groups.append(open_groups[key])
+
+            open_groups[key].append((message, reading))
+
+        return [merged for group in groups for merged in self.merge(group)]
+
+    def get_bucket(self, age, forced_tier=None):
+        bucket = None
+
+        for index, (tier_age, tier_bucket) in enumerate(self.tiers):
+            if age >= tier_age or (forced_tier is not None and index <= forced_tier):
+                bucket = tier_bucket
+
+        return bucket
+
+    @staticmethod
+    def merge(group) -> List[bytes]:
+        if len(group) == 0:
+            return []
+
+        if len(group) == 1:
+            return [group[0][0]]
+
+        # Start from the last reading for its timestamp and cumulative counters, then average the power. Readings that
+        # were merged before count for the number of readings they replaced, so compacting twice gives the same mean.
+        readings = [reading for _, reading in group]
+        weights = [reading.get('samples', 1) for reading in readings]
+        merged = dict(readings[-1])
+        merged['samples'] = sum(weights)
+
+        for field in INSTANTANEOUS_FIELDS:
+            if field in merged:
+                merged[field] = round(sum(reading.get(field, 0) * weight for reading, weight in zip(readings, weights))
+                                      / merged['samples'])
+
+        # The compact encoding has no room for the sample count, so merged readings are queued as JSON
+        return [json.dumps(merged).encode('utf-8')]
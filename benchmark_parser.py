@@ -0,0 +1,119 @@
+#!/usr/bin/env python3
+"""Compare the fast telegram parser with dsmr_parser.
+
+Usage: benchmark_parser.py [telegram file] [iterations]
+
+The file is a telegram capture, or holds raw telegrams one after the other. Without a file a sample DSMR 4 telegram is
+used."""
+import sys
+import time
+
+from dsmr_parser import telegram_specifications
+from dsmr_parser.clients.telegram_buffer import TelegramBuffer
+from dsmr_parser.parsers import TelegramParser
+
+from fast_telegram_parser import FastTelegramParser, crc16
+from reader import Reader
+from telegram_capture import read_capture
+
+SAMPLE_LINES = [
+    '/KFM5KAIFA-METER',
+    '',
+    '1-3:0.2.8(42)',
+    '0-0:1.0.0(161113205757W)',
+    '0-0:96.1.1(3960221976967177082151037881335713)',
+    '1-0:1.8.1(001581.123*kWh)',
+    '1-0:1.8.2(001435.706*kWh)',
+    '1-0:2.8.1(000000.000*kWh)',
+    '1-0:2.8.2(000000.000*kWh)',
+    '0-0:96.14.0(0002)',
+    '1-0:1.7.0(02.027*kW)',
+    '1-0:2.7.0(00.000*kW)',
+    '0-0:96.7.21(00015)',
+    '0-0:96.7.9(00007)',
+    '1-0:99.97.0(3)(0-0:96.7.19)(000104180320W)(0000237126*s)(000101000001W)(2147583646*s)(000102000003W)'
+    '(2317482647*s)',
+    '1-0:32.32.0(00000)',
+    '1-0:52.32.0(00000)',
+    '1-0:72.32.0(00000)',
+    '1-0:32.36.0(00000)',
+    '1-0:52.36.0(00000)',
+    '1-0:72.36.0(00000)',
+    '0-0:96.13.1()',
+    '0-0:96.13.0()',
+    '1-0:31.7.0(000*A)',
+    '1-0:51.7.0(006*A)',
+    '1-0:71.7.0(002*A)',
+    '1-0:21.7.0(00.170*kW)',
+    '1-0:22.7.0(00.000*kW)',
+    '1-0:41.7.0(01.247*kW)',
+    '1-0:42.7.0(00.000*kW)',
+    '1-0:61.7.0(00.209*kW)',
+    '1-0:62.7.0(00.000*kW)',
+    '0-1:24.1.0(003)',
+    '0-1:96.1.0(4819243993373755377509728609491464)',
+    '0-1:24.2.1(161129200000W)(00981.443*m3)',
+    '!',
+]
+
+
+def sample_telegram() -> str:
+    telegram = '\r\n'.join(SAMPLE_LINES)
+
+    return f'{telegram}{crc16(telegram.encode("ascii")):04X}\r\n'
+
+
+def load_telegrams(file_name) -> list:
+    if file_name.endswith('.gz'):
+        return [telegram for _, telegram in read_capture(file_name)]
+
+    telegram_buffer = TelegramBuffer()
+
+    with open(file_name, newline='') as telegram_file:
+        telegram_buffer.append(telegram_file.read())
+
+    return list(telegram_buffer.get_all())
+
+
+def benchmark(name, parse, telegrams, iterations) -> float:
+    start = time.perf_counter()
+
+    for _ in range(iterations):
+        for telegram in telegrams:
+            parse(telegram)
+
+    per_telegram = (time.perf_counter() - start) / (iterations * len(telegrams))
+    print(f'{name}: {per_telegram * 1000000:.1f} us per telegram')
+
+    return per_telegram
+
+
+def main():
+    telegrams = load_telegrams(sys.argv[1]) if len(sys.argv) > 1 else [sample_telegram()]
+    iterations = int(sys.argv[2]) if len(sys.argv) > 2 else 1000
+
+    if len(telegrams) == 0:
+        print('No telegrams found')
+        return
+
+    dsmr_parser = TelegramParser(telegram_specifications.V4)
+    fast_parser = FastTelegramParser()
+
+    # Both parsers must produce the same reading before their speed means anything
+    for telegram in telegrams:
+        expected = Reader.telegram_values(dsmr_parser.parse(telegram))
+        actual = fast_parser.parse(telegram)
+
+        if expected != actual:
+            print(f'Parsers disagree on telegram:\n{telegram}\ndsmr_parser: {expected}\nfast: {actual}')
+            return
+
+    print(f'{len(telegrams)} telegram(s), {iterations} iteration(s)')
+    slow = benchmark('dsmr_parser', lambda telegram: Reader.telegram_values(dsmr_parser.parse(telegram)), telegrams,
+                     iterations)
+    fast = benchmark('fast', fast_parser.parse, telegrams, iterations)
+    print(f'Speedup: {slow / fast:.1f}x')
+
+
+if __name__ == '__main__':
+    main()
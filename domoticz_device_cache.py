@@ -0,0 +1,64 @@
+import json
+import logging
+import os
+import threading
+
+
+class DomoticzDeviceCache:
+    """Resolved Domoticz device indexes, persisted to a local JSON file.
+
+    Entries are grouped by Domoticz URL and dummy hardware name, so a changed configuration never reuses stale
+    indexes. Cached indexes are trusted until Domoticz rejects a push for them."""
+
+    def __init__(self, file_name: str, domoticz_url: str, dummy_device_name: str, logger: logging.Logger):
+        self.file_name = file_name
+        self.key = f'{domoticz_url}|{dummy_device_name}'
+        self.logger = logger
+        self.lock = threading.Lock()
+        self.cache = self.load()
+
+    def load(self) -> dict:
+        if not os.path.exists(self.file_name):
+            return {}
+
+        try:
+            with open(self.file_name) as cache_file:
+                return json.load(cache_file)
+        except Exception as e:
+            self.logger.error(f'Failed to load Domoticz device cache {self.file_name}', exc_info=e)
+            return {}
+
+    def save(self):
+        temp_file_name = f'{self.file_name}.tmp'
+
+        try:
+            with open(temp_file_name, 'w') as cache_file:
+                json.dump(self.cache, cache_file)
+
+            os.replace(temp_file_name, self.file_name)
+        except Exception as e:
+            self.logger.error(f'Failed to save Domoticz device cache {self.file_name}', exc_info=e)
+
+    def get(self, name: str):
+        with self.lock:
+            return self.cache.get(self.key, {}).get(name)
+
+    def set(self, name: str, idx):
+        with self.lock:
+            devices = self.cache.setdefault(self.key, {})
+
+            if devices.get(name) == idx:
+                return
+
+            devices[name] = idx
+            self.save()
+
+    def remove(self, name: str):
+        with self.lock:
+            devices = self.cache.get(self.key, {})
+
+            if name not in devices:
+                return
+
+            del devices[name]
+            self.save()
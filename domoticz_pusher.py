@@ -1,15 +1,19 @@
 import logging
+from concurrent.futures import ThreadPoolExecutor
 from threading import Thread
 import threading
-import time
-from multiprocessing import Queue
+from queue import Empty, Queue
 import requests
+from requests.adapters import HTTPAdapter
+from domoticz_device_cache import DomoticzDeviceCache
+from energy_reading import matches_meter
 from read_handler_interface import ReadHandlerInterface
-from redis_queue import RedisQueue
+from last_known_values import LastKnownValues
 
 
 class DomoticzPusher(Thread, ReadHandlerInterface):
-    def __init__(self, config: dict, stop_event: threading.Event, logger: logging.Logger, push_solar: bool):
+    def __init__(self, config: dict, stop_event: threading.Event, logger: logging.Logger, push_solar: bool,
+                 meter_id=None):
         super().__init__()
 
         self.queue: Queue = Queue()
@@ -19,10 +23,26 @@ class DomoticzPusher(Thread, ReadHandlerInterface):
         self.domoticz_url = config['domoticz_url']
         self.dummy_device_name = config['domoticz_dummy_name']
         self.push_solar = push_solar
+        # Domoticz has one set of P1 devices, so in multi-meter mode only one meter is pushed
+        self.meter_id = meter_id
+        self.timeout = config.get('domoticz_timeout', 5)
         self.devices = {}
+        self.device_cache = DomoticzDeviceCache(file_name=config.get('domoticz_cache_file', 'domoticz_devices.json'),
+                                                domoticz_url=self.domoticz_url,
+                                                dummy_device_name=self.dummy_device_name, logger=logger)
+
+        push_workers = config.get('domoticz_push_workers', 8)
+        self.executor = ThreadPoolExecutor(max_workers=push_workers, thread_name_prefix='domoticz-push')
+        self.session = requests.Session()
+        self.session.mount('http://', HTTPAdapter(pool_connections=1, pool_maxsize=push_workers))
+        self.session.mount('https://', HTTPAdapter(pool_connections=1, pool_maxsize=push_workers))
 
         self.set_devices_to_default()
 
+        self.last_known_values = LastKnownValues(logger=logger, use_spool=config.get('queue_backend') == 'spool')
+        self.last_known_values.load([device['last_known_key'] for device in self.devices.values()
+                                     if 'last_known_key' in device])
+
     def set_devices_to_default(self):
         self.devices = {
             'electricity': {
@@ -47,11 +67,11 @@ class DomoticzPusher(Thread, ReadHandlerInterface):
                 'sensor_type': '0xF31D',
                 'idx': -1,
                 'get_data': lambda device, data: f'{data["solarNow"]};'
-                                                 f'{self.get_data_with_queue(device, data["solarTotal"])}',
+                                                 f'{self.get_last_known(device, data["solarTotal"])}',
                 'change_device_url': lambda name, idx: f'/json.htm?type=setused&idx={idx}&name={name}'
                                                        f'&description=&switchtype=4&EnergyMeterMode=0&customimage=0'
                                                        f'&used=true',
-                'queue': RedisQueue('solar_general')
+                'last_known_key': 'solar_general'
             }
 
             self.devices['solar_iac'] = {
@@ -88,7 +108,7 @@ class DomoticzPusher(Thread, ReadHandlerInterface):
                 'sensor_options': '&sensoroptions=1;KW',
                 'idx': -1,
                 'get_data': lambda device, data: f'{self.transform(device, data["allSolar"]["dayEnergy"], "KW")}',
-                'queue': RedisQueue('solar_day_total')
+                'last_known_key': 'solar_day_total'
             }
 
             self.devices['solar_year_total'] = {
@@ -97,7 +117,7 @@ class DomoticzPusher(Thread, ReadHandlerInterface):
                 'sensor_options': '&sensoroptions=1;KW',
                 'idx': -1,
                 'get_data': lambda device, data: f'{self.transform(device, data["allSolar"]["yearEnergy"], "KW")}',
-                'queue': RedisQueue('solar_year_total')
+                'last_known_key': 'solar_year_total'
             }
 
             self.devices['solar_total'] = {
@@ -106,69 +126,82 @@ class DomoticzPusher(Thread, ReadHandlerInterface):
                 'sensor_options': '&sensoroptions=1;MW',
                 'idx': -1,
                 'get_data': lambda device, data: f'{self.transform(device, data["allSolar"]["totalEnergy"], "MW")}',
-                'queue': RedisQueue('solar_total')
+                'last_known_key': 'solar_total'
             }
 
+        for device in self.devices.values():
+            idx = self.device_cache.get(device['name'])
+
+            if idx is not None:
+                device['idx'] = idx
+
     def handle_read(self, data: dict) -> None:
-        self.queue.put_nowait(data)
+        if matches_meter(data, self.meter_id):
+            self.queue.put_nowait(data)
 
     def get_name(self) -> str:
         return 'DomoticzPusher'
 
     def run(self):
         while not self.stop_event.is_set():
-            if self.queue.empty():
-                time.sleep(1)
+            try:
+                data: dict = self.queue.get(timeout=1)
+            except Empty:
                 continue
 
-            if not self.is_connected():
-                time.sleep(10)
-                continue
+            while not self.is_connected():
+                if self.stop_event.wait(10):
+                    # Put the reading back instead of dropping it while waiting for Domoticz
+                    self.queue.put_nowait(data)
+                    break
+            else:
+                self.push_reading(data)
 
-            try:
-                data: dict = self.queue.get_nowait()
+        self.last_known_values.flush()
+
+    def push_reading(self, data: dict):
+        if not matches_meter(data, self.meter_id):
+            return
 
-                for device in self.devices.values():
-                    self.push_data_to_domoticz(device, data)
+        try:
+            # Push all devices concurrently over the keep-alive session, so a reading costs one round trip
+            futures = [self.executor.submit(self.push_data_to_domoticz, device, data)
+                       for device in self.devices.values()]
 
-            except Exception as e:
-                self.logger.error('Failed to push data to Domoticz', exc_info=e)
-                self.reset()
+            for future in futures:
+                future.result()
+
+        except Exception as e:
+            self.logger.error('Failed to push data to Domoticz', exc_info=e)
+            self.reset()
 
     def push_data_to_domoticz(self, device, data):
         s_value = device['get_data'](device, data)
 
         self.logger.debug(f'Sending data to domoticz for {device["name"]}: {s_value}')
-        response = requests.get(f'{self.domoticz_url}/json.htm?type=command&param=udevice&'
-                                f'idx={device["idx"]}&nvalue=0&svalue={s_value}')
+        response = self.get(f'{self.domoticz_url}/json.htm?type=command&param=udevice&'
+                            f'idx={device["idx"]}&nvalue=0&svalue={s_value}')
         if not response.ok:
             raise Exception(f'Received unexpected status code on pushing {device["name"]}: {response.status_code}')
 
         response_json = response.json()
 
         if response_json['status'] != 'OK':
+            # Domoticz rejected the index, so it has to be discovered again
+            self.device_cache.remove(device['name'])
             raise Exception(f'Failed to push {device["name"]}, received status: {response_json["status"]}')
 
-    @staticmethod
-    def get_data_with_queue(device, value):
-        queue = device['queue']
-        last_known = 0
-
-        if not queue.empty():
-            last_known = float(queue.get().decode('utf-8'))
-
+    def get_last_known(self, device, value):
+        # Domoticz counters must never drop to zero, so zero values are replaced by the last known value
         if value > 0:
-            queue.put(value)
+            self.last_known_values.set(device['last_known_key'], value)
             return value
 
-        if last_known > 0:
-            queue.put(last_known)
-
-        return last_known
+        return self.last_known_values.get(device['last_known_key'])
 
     def transform(self, device, value, unit):
-        if 'queue' in device:
-            value = self.get_data_with_queue(device, value)
+        if 'last_known_key' in device:
+            value = self.get_last_known(device, value)
 
         if unit == 'MW':
             return f'{round(value / 1000_000, 3)}'
@@ -177,6 +210,9 @@ class DomoticzPusher(Thread, ReadHandlerInterface):
 
         return f'{value}'
 
+    def get(self, url):
+        return self.session.get(url, timeout=self.timeout)
+
     def reset(self):
         self.connected = False
         self.set_devices_to_default()
@@ -185,10 +221,19 @@ class DomoticzPusher(Thread, ReadHandlerInterface):
         if self.connected:
             return True
 
-        response = requests.get(f'{self.domoticz_url}/json.htm?type=command&param=getversion')
-        response_data = response.json()
+        try:
+            response = self.get(f'{self.domoticz_url}/json.htm?type=command&param=getversion')
+            response_data = response.json()
+        except (requests.RequestException, ValueError) as e:
+            # A stalled or unreachable Domoticz must not end the pusher, it is retried on the next reading
+            self.logger.error('Could not connect to Domoticz', exc_info=e)
+            return False
 
         if response.ok and response_data['status'] == 'OK':
+            if all(device['idx'] != -1 for device in self.devices.values()):
+                self.connected = True
+                return True
+
             success = self.try_find_idx_devices()
 
             if not success:
@@ -203,7 +248,7 @@ class DomoticzPusher(Thread, ReadHandlerInterface):
         found_all_devices = True
 
         try:
-            response = requests.get(f'{self.domoticz_url}/json.htm?type=command&param=devices_list')
+            response = self.get(f'{self.domoticz_url}/json.htm?type=command&param=devices_list')
 
             if not response.ok:
                 raise Exception(f'Received unexpected status code on get hardware: {response.status_code}')
@@ -214,9 +259,16 @@ class DomoticzPusher(Thread, ReadHandlerInterface):
                 raise Exception(f'Get devices returned {response_json["status"]}')
 
             devices = response_json['result'] if 'result' in response_json else []
+            devices_by_name = {}
+
+            for d in devices:
+                devices_by_name.setdefault(d['name'], d)
 
             for device in self.devices.values():
-                domoticz_device = next((d for d in devices if d['name'] == device['name']), None)
+                if device['idx'] != -1:
+                    continue
+
+                domoticz_device = devices_by_name.get(device['name'])
 
                 if domoticz_device is not None:
                     if 'value' in domoticz_device:
@@ -225,6 +277,8 @@ class DomoticzPusher(Thread, ReadHandlerInterface):
                         device['idx'] = domoticz_device['idx']
                     else:
                         raise Exception('Encountered unknown domoticz_device format')
+
+                    self.device_cache.set(device['name'], device['idx'])
                 else:
                     found_all_devices = False
 
@@ -235,7 +289,7 @@ class DomoticzPusher(Thread, ReadHandlerInterface):
 
     def try_store_hardware(self) -> bool:
         try:
-            response = requests.get(f'{self.domoticz_url}/json.htm?type=hardware')
+            response = self.get(f'{self.domoticz_url}/json.htm?type=hardware')
 
             if not response.ok:
                 raise Exception(f'Received unexpected status code on get hardware: {response.status_code}')
@@ -263,7 +317,7 @@ class DomoticzPusher(Thread, ReadHandlerInterface):
 
             if dummy_device_idx is None:
                 self.logger.info(f'Creating new domoticz dummy device with name "{self.dummy_device_name}"')
-                response = requests.get(f'{self.domoticz_url}/json.htm?type=command&param=addhardware&htype=15&port=1'
+                response = self.get(f'{self.domoticz_url}/json.htm?type=command&param=addhardware&htype=15&port=1'
                                         f'&name={self.dummy_device_name}&enabled=true')
 
                 if not response.ok:
@@ -286,6 +340,7 @@ class DomoticzPusher(Thread, ReadHandlerInterface):
                         return False
 
                     device['idx'] = idx
+                    self.device_cache.set(device['name'], idx)
 
             return True
         except Exception as e:
@@ -306,7 +361,7 @@ class DomoticzPusher(Thread, ReadHandlerInterface):
             if 'sensor_options' in device:
                 create_url += device['sensor_options']
 
-            response = requests.get(create_url)
+            response = self.get(create_url)
 
             if not response.ok:
                 raise Exception(f'Received unexpected status code on creating device {name}: {response.status_code}')
@@ -320,7 +375,7 @@ class DomoticzPusher(Thread, ReadHandlerInterface):
             idx = response_json['idx']
 
             if 'change_device_url' in device:
-                response = requests.get(f'{self.domoticz_url}{device["change_device_url"](name, idx)}')
+                response = self.get(f'{self.domoticz_url}{device["change_device_url"](name, idx)}')
 
                 if not response.ok:
                     raise Exception(
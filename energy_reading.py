@@ -0,0 +1,100 @@
+import json
+from collections.abc import Mapping
+
+import reading_codec
+
+# Keys that are only used by local sinks and are never sent to the energy portals
+LOCAL_KEYS = ('allSolar', 'powerStats', 'meterId')
+
+
+def matches_meter(data, meter_id) -> bool:
+    """Return True when a sink that is routed to meter_id (None for all meters) should handle the reading."""
+    reading_meter_id = data.get('meterId')
+
+    # Compare as strings, meter ids may be configured as numbers in one place and as strings in another
+    return meter_id is None or reading_meter_id is None or str(reading_meter_id) == str(meter_id)
+
+
+class EnergyReading(Mapping):
+    """Immutable reading shared by all read handlers.
+
+    The encodings the sinks need are computed on first use and cached, so a reading is serialized once no matter how
+    many handlers consume it."""
+
+    __slots__ = ('_data', '_portal_json', '_portal_compact', '_mqtt_json', '_mqtt_values')
+
+    def __init__(self, data: dict):
+        self._data = data
+        self._portal_json = None
+        self._portal_compact = None
+        self._mqtt_json = None
+        self._mqtt_values = None
+
+    @staticmethod
+    def of(data) -> 'EnergyReading':
+        return data if isinstance(data, EnergyReading) else EnergyReading(data)
+
+    def __getitem__(self, key):
+        return self._data[key]
+
+    def __iter__(self):
+        return iter(self._data)
+
+    def __len__(self):
+        return len(self._data)
+
+    def __repr__(self):
+        return repr(self._data)
+
+    @property
+    def meter_id(self):
+        return self._data.get('meterId')
+
+    def portal_data(self) -> dict:
+        return {key: value for key, value in self._data.items() if key not in LOCAL_KEYS}
+
+    def portal_json(self) -> bytes:
+        if self._portal_json is None:
+            self._portal_json = json.dumps(self.portal_data()).encode('utf-8')
+
+        return self._portal_json
+
+    def portal_compact(self) -> bytes:
+        if self._portal_compact is None:
+            self._portal_compact = reading_codec.encode(self.portal_data())
+
+        return self._portal_compact
+
+    def mqtt_json(self) -> str:
+        if self._mqtt_json is None:
+            payload = dict(self._data)
+
+            if 'usageGasTotal' in payload:
+                payload['usageGasTotal'] = float(payload['usageGasTotal']) / 1000
+
+            self._mqtt_json = json.dumps(payload, separators=(',', ':'))
+
+        return self._mqtt_json
+
+    def mqtt_values(self) -> list:
+        """Return (topic suffix, payload) pairs for every leaf value of the reading."""
+        if self._mqtt_values is None:
+            values = []
+            self.collect_mqtt_values('', self._data, values)
+            self._mqtt_values = values
+
+        return self._mqtt_values
+
+    @staticmethod
+    def collect_mqtt_values(prefix, data: dict, values: list):
+        for key, value in data.items():
+            topic = f'{prefix}/{key}' if prefix else key
+
+            if isinstance(value, dict):
+                EnergyReading.collect_mqtt_values(topic, value, values)
+            elif key == 'usageGasTotal':
+                values.append((topic, float(value) / 1000))
+            elif isinstance(value, (float, int)):
+                values.append((topic, value))
+            else:
+                values.append((topic, str(value)))
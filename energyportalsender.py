@@ -1,13 +1,18 @@
-from redis_queue import RedisQueue
+from enums import SendResult
+from backlog_manager import BacklogManager
+from portal_queue import ListPortalQueue, create_portal_queue
+from reading_codec import decode
 import time
 import threading
+from email.utils import parsedate_to_datetime
+from typing import List
 import requests
-import json
+import gzip
 import logging
 
 
 class EnergyPortalSender(threading.Thread):
-    def __init__(self, stop_event, config, logger: logging.Logger):
+    def __init__(self, stop_event, config, logger: logging.Logger, queue_backend='lists'):
         super(EnergyPortalSender, self).__init__()
 
         self.daemon = True
@@ -19,13 +24,36 @@ class EnergyPortalSender(threading.Thread):
         self.key = config["key"]
         self.name = config["name"]
         self.max_batch_size = config["max_batch_size"]
+        self.max_catch_up_batch_size = config.get("max_catch_up_batch_size", 500)
+        self.target_response_time = config.get("target_response_time", 2)
+        self.idle_wait = config.get("idle_wait", 5)
+        self.gzip_min_bytes = config.get("gzip_min_bytes", 0)
+        self.timeout = config.get("timeout", 30)
         self.store_energy_url = self.base_url + "/api/v3/energy"
         self.backup_file = "backup"
 
-        self.normal_data_queue = RedisQueue(f'normal_{self.name}')
-        self.retry_data_queue = RedisQueue(f'retry_{self.name}')
+        self.portal_queue = create_portal_queue(queue_backend, self.name, config)
+        self.backlog_manager = None
 
+        if 'backlog' in config and isinstance(self.portal_queue, ListPortalQueue):
+            self.backlog_manager = BacklogManager(self.portal_queue.normal_data_queue, config['backlog'], logger)
+
+        # Rejection count per message, only messages that were rejected on their own are tracked
+        self.max_attempts = config.get("max_attempts", 3)
+        self.attempts = {}
+        self.attempts_lock = threading.Lock()
+
+        # Workers claim disjoint batches from the queues, the semaphore caps the number of concurrent requests
+        self.workers = config.get("workers", 1)
+        self.in_flight = threading.BoundedSemaphore(config.get("max_in_flight", self.workers))
+        # Every worker adapts its own batch size to the response times it sees
+        self.batch_sizes = {}
+
+        # The connection is shared by the workers, the lock lets one of them reconnect while the others wait
         self.connected = False
+        self.connect_lock = threading.Lock()
+        # Time before which the server asked not to be bothered, by answering 408 or 429
+        self.retry_at = 0
 
     def run(self):
         if not self.enabled:
@@ -34,73 +62,163 @@ class EnergyPortalSender(threading.Thread):
 
         self.logger.info('Sender has been started')
 
+        workers = [threading.Thread(target=self.drain, args=(i,), name=f'{self.name} worker {i}', daemon=True)
+                   for i in range(1, self.workers)]
+
+        for worker in workers:
+            worker.start()
+
+        self.drain()
+
+        for worker in workers:
+            worker.join()
+
+        self.logger.info('Sender has been terminated')
+
+    def drain(self, worker=0):
         while not self.stop_event.is_set():
             try:
+                # The backlog grows while the portal cannot be reached, so it is managed before connecting
+                self.manage_backlog()
+
                 if not self.connected:
                     self.connect_to_api()
 
-                while self.connected:
-                    retry_data = self.read_messages_from_retry_queue()
+                if not self.connected:
+                    self.stop_event.wait(5)
+                    continue
+
+                # Keep sending back-to-back while there is a backlog, block on the queue while idle
+                result = self.send_next_batch(wait_timeout=self.idle_wait, worker=worker)
+
+                if result == SendResult.FAILED:
+                    self.stop_event.wait(self.get_retry_delay())
+            except Exception as e:
+                self.logger.error('Failed to send data', exc_info=e)
+                self.stop_event.wait(5)
 
-                    if len(retry_data) > 0:
-                        self.send_data_to_api(retry_data)
-                        break
+    def manage_backlog(self):
+        if self.backlog_manager is not None:
+            self.backlog_manager.run_if_due()
 
-                    normal_data = self.read_messages_from_normal_queue()
+    def send_next_batch(self, wait_timeout=0, worker=0) -> SendResult:
+        """Send one batch, taking retries before new data.
 
-                    if len(normal_data) > 0:
-                        self.send_data_to_api(normal_data)
-                        break
+        When both queues are empty, wait up to wait_timeout seconds for new data to arrive. The worker number
+        identifies the worker to the queue, so the batches it fails to send are read again by the same worker."""
+        retry_data = self.read_messages_from_retry_queue(worker)
 
-                    time.sleep(1)
+        if len(retry_data) > 0:
+            return self.send_batch(retry_data, worker)
 
-                time.sleep(5)
-            except Exception as e:
-                self.logger.error('Failed to send data', exc_info=e)
+        normal_data = self.read_messages_from_normal_queue(wait_timeout, worker)
 
-        self.logger.info('Sender has been terminated')
+        if len(normal_data) > 0:
+            return self.send_batch(normal_data, worker)
+
+        return SendResult.EMPTY
 
-    def read_messages_from_retry_queue(self):
-        retry_data = []
+    def send_batch(self, messages, worker=0) -> SendResult:
+        start = time.time()
+        success = self.send_data_to_api(messages)
+        self.adapt_batch_size(success, len(messages), time.time() - start, worker)
 
-        while not self.retry_data_queue.empty():
-            retry_message = self.retry_data_queue.get()
-            retry_data.append(json.loads(retry_message.decode('utf-8')))
+        return SendResult.SENT if success else SendResult.FAILED
 
-            if len(retry_data) > self.max_batch_size:
-                break
+    def get_batch_size(self, worker=0) -> int:
+        return self.batch_sizes.get(worker, self.max_batch_size)
+
+    def adapt_batch_size(self, success, sent, response_time, worker=0):
+        """Grow the batch size while the server keeps up with full batches, back off on slow responses or errors."""
+        batch_size = self.get_batch_size(worker)
+
+        if not success:
+            batch_size = self.max_batch_size
+        elif response_time > self.target_response_time:
+            batch_size = max(self.max_batch_size, batch_size // 2)
+        elif sent >= batch_size:
+            batch_size = min(self.max_catch_up_batch_size, batch_size * 2)
+
+        self.batch_sizes[worker] = batch_size
+
+    def read_messages_from_retry_queue(self, worker=0):
+        retry_data = self.portal_queue.get_retry(self.get_batch_size(worker), worker)
 
         if len(retry_data) > 0:
             self.logger.debug(f'{len(retry_data)} message(s) are scheduled for retry.')
 
         return retry_data
 
-    def read_messages_from_normal_queue(self):
-        normal_data = []
+    def read_messages_from_normal_queue(self, wait_timeout=0, worker=0):
+        return self.portal_queue.get_new(self.get_batch_size(worker), wait_timeout, worker)
+
+    def connect_to_api(self):
+        with self.connect_lock:
+            # Another worker may have reconnected while this one waited for the lock
+            if self.connected:
+                return
+
+            try:
+                response = requests.get(self.base_url, timeout=self.timeout)
+                self.connected = response.status_code == requests.codes.ok
 
-        while not self.normal_data_queue.empty():
-            normal_message = self.normal_data_queue.get()
-            normal_data.append(json.loads(normal_message.decode('utf-8')))
+                if response.status_code == requests.codes.ok:
+                    self.logger.info('Connected to server running on {}'.format(self.base_url))
 
-            if len(normal_data) > self.max_batch_size:
-                break
+            except (requests.exceptions.ConnectionError, requests.exceptions.Timeout):
+                self.connected = False
+                self.logger.error('Could not connect to the server')
 
-        return normal_data
+    def send_data_to_api(self, messages: List[bytes]) -> bool:
+        """Send the messages, bisecting batches the server rejects to isolate bad messages.
 
-    def connect_to_api(self):
-        try:
-            response = requests.get(self.base_url)
-            self.connected = response.status_code == requests.codes.ok
+        Returns True when every message has been stored or moved to the dead letter queue. Anything that could not be
+        sent is put back at the head of the retry queue, so the original order is kept."""
+        chunks = [messages]
 
-            if response.status_code == requests.codes.ok:
-                self.connected = True
-                self.logger.info('Connected to server running on {}'.format(self.base_url))
+        while len(chunks) > 0:
+            chunk = chunks.pop(0)
+            status_code = self.post_messages(chunk)
 
-        except requests.exceptions.ConnectionError as e:
-            self.connected = False
-            self.logger.error('Could not connect to the server')
+            if status_code == requests.codes.created:
+                self.logger.debug('Successfully stored energy data')
+                self.portal_queue.ack(chunk)
+                self.clear_attempts(chunk)
+                continue
 
-    def send_data_to_api(self, messages):
+            if status_code == requests.codes.unauthorized:
+                self.logger.error('Could not authorize with given key')
+                self.stop_event.set()
+            elif status_code is None:
+                self.connected = False
+            elif status_code == requests.codes.request_entity_too_large:
+                # The batch is too big, not wrong, so halving it does not count as an attempt
+                if len(chunk) > 1:
+                    middle = len(chunk) // 2
+                    chunks[0:0] = [chunk[:middle], chunk[middle:]]
+                    continue
+
+                self.logger.error('Message is too large to be sent on its own')
+                self.store_message_in_dead_letter_queue(chunk[0])
+                continue
+            elif status_code in (requests.codes.bad_request, requests.codes.unprocessable_entity):
+                # The server rejected the data itself, find out which message is to blame
+                if len(chunk) > 1:
+                    middle = len(chunk) // 2
+                    chunks[0:0] = [chunk[:middle], chunk[middle:]]
+                    continue
+
+                if self.register_attempt(chunk[0]) >= self.max_attempts:
+                    self.store_message_in_dead_letter_queue(chunk[0])
+                    continue
+
+            self.store_messages_in_retry_queue([message for c in [chunk] + chunks for message in c])
+            return False
+
+        return True
+
+    def post_messages(self, messages: List[bytes]) -> int or None:
+        """Post the messages to the api and return the status code, or None if the server could not be reached."""
         headers = {
             'Content-type': 'application/json',
             'Accept': 'application/json',
@@ -108,37 +226,78 @@ class EnergyPortalSender(threading.Thread):
         }
 
         try:
-            data = {
-                "metrics": messages
-            }
+            # The queued messages are already JSON (or are decoded to JSON only now), so they are spliced into the
+            # body without parsing them
+            data = b'{"metrics":[' + b','.join(decode(message) for message in messages) + b']}'
 
-            self.logger.debug(f'{len(messages)} energy message(s) will be send to the api')
+            if 0 < self.gzip_min_bytes <= len(data):
+                data = gzip.compress(data)
+                headers['Content-Encoding'] = 'gzip'
 
-            response = requests.post(self.store_energy_url, data=json.dumps(data),
-                                     headers=headers)
+            self.logger.debug(f'{len(messages)} energy message(s) will be send to the api')
 
-            if response.status_code == requests.codes.created:
-                self.logger.debug('Successfully stored energy data')
-                return
+            with self.in_flight:
+                response = requests.post(self.store_energy_url, data=data, headers=headers, timeout=self.timeout)
 
-            if response.status_code == requests.codes.unauthorized:
-                self.logger.error('Could not authorize with given key')
-                self.stop_event.set()
-                return
+            if response.status_code in (requests.codes.request_timeout, requests.codes.too_many_requests):
+                self.retry_at = time.time() + self.parse_retry_after(response.headers.get('Retry-After'))
 
-            self.logger.error(f'Received unexpected status code \'{response.status_code}\' with response: '
-                              f'{response.json()}')
+            if response.status_code not in (requests.codes.created, requests.codes.unauthorized):
+                self.logger.error(f'Received unexpected status code \'{response.status_code}\' with response: '
+                                  f'{response.text}')
 
-            self.store_messages_in_retry_queue(messages)
+            return response.status_code
 
-        except requests.exceptions.ConnectionError as e:
+        except requests.exceptions.ConnectionError:
             self.logger.error('Could not reach the server')
+            return None
+        except requests.exceptions.Timeout:
+            self.logger.error(f'The server did not respond within {self.timeout} seconds')
+            return None
+
+    @staticmethod
+    def parse_retry_after(value) -> float:
+        """Return the delay in seconds of a Retry-After header, which holds either seconds or an HTTP date."""
+        if value is None:
+            return 5
+
+        try:
+            return max(0, float(value))
+        except ValueError:
+            pass
+
+        try:
+            return max(0, parsedate_to_datetime(value).timestamp() - time.time())
+        except (TypeError, ValueError):
+            return 5
 
-            self.connected = False
-            self.store_messages_in_retry_queue(messages)
+    def get_retry_delay(self) -> float:
+        """Return how long to wait after a batch failed, which is longer when the server asked for it."""
+        return max(5, self.retry_at - time.time())
+
+    def register_attempt(self, message: bytes) -> int:
+        with self.attempts_lock:
+            attempts = self.attempts.get(message, 0) + 1
+            self.attempts[message] = attempts
+
+        return attempts
+
+    def clear_attempts(self, messages: List[bytes]):
+        with self.attempts_lock:
+            if len(self.attempts) == 0:
+                return
+
+            for message in messages:
+                self.attempts.pop(message, None)
 
     def store_messages_in_retry_queue(self, messages):
         self.logger.debug(f'Storing {len(messages)} in de retry queue')
+        self.portal_queue.requeue(messages)
+
+    def store_message_in_dead_letter_queue(self, message):
+        with self.attempts_lock:
+            attempts = self.attempts.pop(message, 0)
 
-        for message in messages:
-            self.retry_data_queue.put(json.dumps(message))
+        self.logger.error(f'Message was rejected {attempts} time(s), moving it to '
+                          f'{self.portal_queue.dead_letter_key}: {message}')
+        self.portal_queue.dead_letter(message)
@@ -18,3 +18,15 @@ class Error(Enum):
     SERVER_ERROR = "SERVER_ERROR"
     READING = "READING"
     SOLAR_API = "SOLAR_API"
+
+
+class OverflowPolicy(Enum):
+    DROP_OLDEST = "drop_oldest"
+    DROP_NEWEST = "drop_newest"
+    BLOCK = "block"
+
+
+class SendResult(Enum):
+    EMPTY = "EMPTY"
+    SENT = "SENT"
+    FAILED = "FAILED"
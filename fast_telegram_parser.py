@@ -0,0 +1,109 @@
+from dsmr_parser.exceptions import InvalidChecksumError, ParseError
+
+# OBIS codes of the values a reading is made of, without the medium and channel, mapped to the reading field and the
+# number of decimals that are kept by the int value (3 turns kW into W, kWh into Wh and m3 into dm3)
+READING_OBIS_CODES = {
+    '96.14.0': ('mode', 0),
+    '1.7.0': ('usageNow', 3),
+    '2.7.0': ('redeliveryNow', 3),
+    '1.8.2': ('usageTotalHigh', 3),
+    '2.8.2': ('redeliveryTotalHigh', 3),
+    '1.8.1': ('usageTotalLow', 3),
+    '2.8.1': ('redeliveryTotalLow', 3),
+    '24.2.1': ('usageGasTotal', 3),
+}
+
+
+def build_crc16_table() -> list:
+    table = []
+
+    for byte in range(256):
+        crc = byte
+
+        for _ in range(8):
+            crc = (crc >> 1) ^ 0xA001 if crc & 1 else crc >> 1
+
+        table.append(crc)
+
+    return table
+
+
+CRC16_TABLE = build_crc16_table()
+
+
+def crc16(data: bytes) -> int:
+    """CRC16/ARC as used by DSMR 4 and up, from the '/' up to and including the '!' of a telegram."""
+    crc = 0
+
+    for byte in data:
+        crc = (crc >> 8) ^ CRC16_TABLE[(crc ^ byte) & 0xFF]
+
+    return crc
+
+
+def to_int(value: str, decimals: int) -> int:
+    # Shift the decimal point instead of going through Decimal or float, extra decimals are truncated like int() does
+    whole, _, fraction = value.partition('.')
+
+    if decimals == 0:
+        return int(whole)
+
+    return int(whole + fraction[:decimals].ljust(decimals, '0'))
+
+
+class FastTelegramParser(object):
+    """Lean telegram parser that only extracts the given OBIS codes, as ints.
+
+    The telegram is scanned once, line by line, and the CRC is validated when the telegram has one. It raises the
+    exceptions of dsmr_parser, so it can be used in place of its TelegramParser."""
+
+    def __init__(self, obis_codes: dict = None):
+        self.obis_codes = obis_codes or READING_OBIS_CODES
+
+    def parse(self, telegram: str) -> dict:
+        end = telegram.rfind('!')
+
+        if telegram[:1] != '/' or end < 0:
+            raise ParseError('Telegram is incomplete, the start and/or end are missing')
+
+        checksum = telegram[end + 1:end + 5]
+
+        if checksum.strip() != '':
+            try:
+                expected_crc = int(checksum, 16)
+            except ValueError:
+                raise ParseError(f'Telegram has an invalid checksum: {checksum}')
+
+            calculated_crc = crc16(telegram[:end + 1].encode('ascii'))
+
+            if calculated_crc != expected_crc:
+                raise InvalidChecksumError(f"Invalid telegram. The CRC checksum '{calculated_crc}' does not match "
+                                           f"the expected '{expected_crc}'")
+
+        values = {}
+
+        for line in telegram[:end].split('\n'):
+            value_start = line.find('(')
+
+            if value_start < 0:
+                continue
+
+            code = self.obis_codes.get(line[line.find(':') + 1:value_start])
+
+            if code is None:
+                continue
+
+            field, decimals = code
+            # The value is the last group, the gas reading is preceded by the time it was measured
+            value = line[line.rfind('(') + 1:line.rfind(')')].partition('*')[0]
+
+            try:
+                values[field] = to_int(value, decimals)
+            except ValueError:
+                raise ParseError(f'Failed to parse the value of line {line.strip()}')
+
+        if len(values) < len(self.obis_codes):
+            missing = [field for field, _ in self.obis_codes.values() if field not in values]
+            raise ParseError(f'Telegram is missing values for {", ".join(missing)}')
+
+        return values
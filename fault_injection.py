@@ -0,0 +1,86 @@
+import time
+
+from read_handler_interface import ReadHandlerInterface
+
+# Faults that are switched on by the scenarios of the mock reader: name -> (target, active until). The pipeline knows
+# nothing about them, the mock setup wraps the objects a fault applies to.
+_faults = {}
+# Only the mock reader enables faults, so the hooks can never affect a deployment that reads a real meter
+_enabled = False
+
+
+def enable():
+    global _enabled
+    _enabled = True
+
+
+def inject(name, duration, target=None):
+    """Activate a fault for duration seconds, for the given target only (e.g. a portal name) or for all targets."""
+    if not _enabled:
+        return
+
+    _faults[name] = (target, time.time() + duration)
+
+
+def clear(name):
+    _faults.pop(name, None)
+
+
+def is_active(name, target=None) -> bool:
+    if not _enabled:
+        return False
+
+    fault = _faults.get(name)
+
+    if fault is None:
+        return False
+
+    fault_target, until = fault
+
+    return time.time() < until and (fault_target is None or fault_target == target)
+
+
+def wait_while_active(name, target=None):
+    """Block while the fault is active, the way a call to a stalled server would."""
+    while is_active(name, target):
+        time.sleep(0.1)
+
+
+class StallingReadHandler(ReadHandlerInterface):
+    """Passes readings on to a read handler, but blocks first while the redis_stall fault is active."""
+
+    def __init__(self, read_handler: ReadHandlerInterface):
+        self.read_handler = read_handler
+
+    def handle_read(self, data: dict) -> None:
+        wait_while_active('redis_stall')
+        self.read_handler.handle_read(data)
+
+    def get_name(self) -> str:
+        return self.read_handler.get_name()
+
+
+def simulate_portal_outages(sender):
+    """Make an energy portal sender fail to reach its portal while a portal_outage fault targets it."""
+    connect_to_api = sender.connect_to_api
+    post_messages = sender.post_messages
+
+    def connect_to_api_unless_out():
+        if not is_active('portal_outage', sender.name):
+            connect_to_api()
+            return
+
+        sender.connected = False
+        sender.logger.error('Could not connect to the server')
+
+    def post_messages_unless_out(messages):
+        if not is_active('portal_outage', sender.name):
+            return post_messages(messages)
+
+        sender.logger.error('Could not reach the server')
+        return None
+
+    sender.connect_to_api = connect_to_api_unless_out
+    sender.post_messages = post_messages_unless_out
+
+    return sender
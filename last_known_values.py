@@ -0,0 +1,82 @@
+import logging
+import threading
+import time
+
+from redis_queue import get_client
+from sqlite_queue import get_spool
+
+
+class LastKnownValues:
+    """In-memory store of last known values, written behind to a Redis hash or to the SQLite spool.
+
+    The values are loaded once at startup and flushed at most every flush_interval seconds, instead of touching
+    storage on every read and write."""
+
+    def __init__(self, logger: logging.Logger, key='domoticz:last_known', flush_interval=60, use_spool=False):
+        self.logger = logger
+        self.key = key
+        self.flush_interval = flush_interval
+        self.spool = get_spool() if use_spool else None
+        self.client = get_client() if not use_spool else None
+        self.lock = threading.Lock()
+        self.values = {}
+        self.dirty = False
+        self.last_flush = time.time()
+
+    def load(self, names):
+        """Load the stored values, falling back to the lists used by earlier versions."""
+        try:
+            if self.spool is not None:
+                self.values = {name: float(value) for name, value in self.spool.get_values(self.key).items()}
+                return
+
+            stored = self.client.hgetall(self.key)
+
+            for name in names:
+                value = stored.get(name.encode('utf-8'))
+
+                if value is None:
+                    value = self.client.lindex(f'queue:{name}', -1)
+
+                if value is not None:
+                    self.values[name] = float(value.decode('utf-8'))
+        except Exception as e:
+            self.logger.error('Failed to load last known values', exc_info=e)
+
+    def get(self, name) -> float:
+        with self.lock:
+            return self.values.get(name, 0)
+
+    def set(self, name, value):
+        with self.lock:
+            if self.values.get(name) == value:
+                return
+
+            self.values[name] = value
+            self.dirty = True
+
+        self.flush_if_due()
+
+    def flush_if_due(self):
+        if time.time() - self.last_flush >= self.flush_interval:
+            self.flush()
+
+    def flush(self):
+        with self.lock:
+            if not self.dirty:
+                return
+
+            values = dict(self.values)
+            self.dirty = False
+            self.last_flush = time.time()
+
+        try:
+            if self.spool is not None:
+                self.spool.set_values(self.key, values)
+            else:
+                self.client.hset(self.key, mapping=values)
+        except Exception as e:
+            self.logger.error('Failed to store last known values', exc_info=e)
+
+            with self.lock:
+                self.dirty = True
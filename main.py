@@ -2,11 +2,15 @@
 import signal
 import sys
 
+import fault_injection
+from async_runtime import AsyncRuntime
 from domoticz_pusher import DomoticzPusher
 from mocker import Mocker
 from mqtt_publisher import MqttPublisher
+from read_dispatcher import ReadDispatcher
 from read_handler_interface import ReadHandlerInterface
 from reader import Reader
+from solar_poller import SolarPoller
 from energyportalsender import EnergyPortalSender
 import threading
 import json
@@ -16,6 +20,8 @@ import time
 from urllib.parse import urlparse
 
 from redis_pusher import RedisPusher
+from replay_reader import ReplayReader
+from sqlite_queue import set_spool_file
 
 
 class MainEnergyReader(threading.Thread):
@@ -34,6 +40,15 @@ class MainEnergyReader(threading.Thread):
         self.debug = True if self.config["debug"] == "true" else False
         self.push_to_domoticz = True if self.valid_uri(self.config["domoticz_url"]) else False
         self.push_solar = True if self.valid_uri(self.config["solar_ip"]) else False
+        self.use_asyncio = self.config.get('runtime', 'threaded') == 'asyncio'
+        self.queue_backend = self.config.get('queue_backend', 'lists')
+        self.queue_encoding = self.config.get('queue_encoding', 'json')
+        # In multi-meter mode every meter is read by its own reader, sinks that take one meter default to the first
+        self.meters = self.config.get('meters', [])
+        self.default_meter = self.meters[0]['id'] if len(self.meters) > 0 else None
+
+        if self.queue_backend == 'spool':
+            set_spool_file(self.config.get('spool_file', 'energy_reader_spool.db'))
         self.stop = False
 
         formatter = logging.Formatter('%(asctime)s - %(name)s - %(levelname)s - %(message)s')
@@ -45,6 +60,10 @@ class MainEnergyReader(threading.Thread):
         self.stream_handler.setFormatter(formatter)
 
         self.logger = self.create_logger('main')
+        self.check_meters()
+
+        if self.local:
+            Mocker.check_config(self.config.get('mocker') or {})
 
     @staticmethod
     def load_config():
@@ -54,43 +73,52 @@ class MainEnergyReader(threading.Thread):
         return config
 
     def run(self):
+        if self.use_asyncio:
+            self.run_asyncio()
+            return
+
         energy_portal_configs = self.get_energy_portal_configs()
-        redis_queue_names = list(map(lambda c: c['name'], energy_portal_configs))
 
         read_handlers: list[ReadHandlerInterface] = [
-            RedisPusher(logger=self.create_logger('RedisPusher'), queue_names=redis_queue_names),
+            self.create_redis_pusher(energy_portal_configs),
         ]
 
         domoticz_pusher = None
 
         if self.push_to_domoticz:
-            domoticz_pusher = DomoticzPusher(config=self.config, logger=self.create_logger('DomoticzPusher'),
-                                             stop_event=self.stop_reader_event, push_solar=self.push_solar)
+            domoticz_pusher = self.create_domoticz_pusher()
             domoticz_pusher.start()
             read_handlers.append(domoticz_pusher)
 
         self.register_mqtt_publishers(read_handlers=read_handlers)
 
-        if self.local:
-            reader = Mocker(stop_event=self.stop_reader_event, logger=self.create_logger('Mocker'),
-                            read_handlers=read_handlers)
-        else:
-            reader = Reader(config=self.config, stop_event=self.stop_reader_event, logger=self.create_logger('Reader'),
-                            read_handlers=read_handlers)
+        dispatcher = ReadDispatcher(config=self.config, stop_event=self.stop_reader_event,
+                                    logger=self.create_logger('ReadDispatcher'))
+        read_handlers = dispatcher.wrap(read_handlers)
+
+        readers = self.get_readers(read_handlers=read_handlers)
 
-        reader.start()
+        for reader in readers:
+            reader.start()
 
         senders = self.get_senders(energy_portal_configs=energy_portal_configs)
 
         for sender in senders:
             sender.start()
 
+        stats_logged = time.time()
+
         while not self.stop:
             stop = False
 
-            if not reader.is_alive():
-                self.logger.error('Reader thread is dead, exit application')
-                stop = True
+            if time.time() - stats_logged >= 60:
+                stats_logged = time.time()
+                self.logger.debug(f'Read handler stats: {dispatcher.get_stats()}')
+
+            for reader in readers:
+                if not reader.is_alive():
+                    self.logger.error(f'Reader thread {reader.name} is dead, exit application')
+                    stop = True
 
             if domoticz_pusher is not None and not domoticz_pusher.is_alive():
                 self.logger.error('Domoticz pusher thread is dead, exit application')
@@ -107,7 +135,9 @@ class MainEnergyReader(threading.Thread):
             time.sleep(0.2)
 
         self.logger.info('Shutting down...')
-        reader.join()
+
+        for reader in readers:
+            reader.join()
 
         for sender in senders:
             sender.join()
@@ -115,6 +145,28 @@ class MainEnergyReader(threading.Thread):
         if domoticz_pusher is not None:
             domoticz_pusher.join()
 
+    def run_asyncio(self):
+        energy_portal_configs = self.get_energy_portal_configs()
+
+        redis_pusher = self.create_redis_pusher(energy_portal_configs)
+        domoticz_pusher = None
+
+        if self.push_to_domoticz:
+            domoticz_pusher = self.create_domoticz_pusher()
+
+        mqtt_publishers = [publisher for publisher in self.get_mqtt_publishers() if publisher.enabled]
+        senders = [sender for sender in self.get_senders(energy_portal_configs=energy_portal_configs)
+                   if sender.enabled]
+
+        readers = self.get_readers(read_handlers=[])
+
+        runtime = AsyncRuntime(config=self.config, stop_event=self.stop_reader_event,
+                               logger=self.create_logger('AsyncRuntime'), readers=readers, redis_pusher=redis_pusher,
+                               domoticz_pusher=domoticz_pusher, mqtt_publishers=mqtt_publishers, senders=senders)
+        runtime.run()
+
+        self.logger.info('Shutting down...')
+
     def stop_all_threads(self):
         self.logger.info('Stopping all threads...')
         self.stop_reader_event.set()
@@ -144,32 +196,105 @@ class MainEnergyReader(threading.Thread):
 
     def get_energy_portal_configs(self):
         if 'energy_portals' not in self.config:
-            return [
+            energy_portal_configs = [
                 {
                     'name': 'default',
                     'api_url': self.config['api_url'],
                     'key': self.config['key']
                 }
             ]
+        else:
+            energy_portal_configs = self.config['energy_portals']
+
+        # A portal account belongs to one meter, so a portal without a meter gets the first one in multi-meter mode
+        return [dict(config, meter=config.get('meter', self.default_meter)) for config in energy_portal_configs]
+
+    def check_meters(self):
+        """Refuse meters that would read the same device, and warn about meters whose readings reach no portal."""
+        devices = [meter.get('device', Reader.DEVICE) for meter in self.meters]
+        shared_devices = sorted({device for device in devices if devices.count(device) > 1})
+
+        if len(shared_devices) > 0:
+            raise ValueError(f'Every meter needs a device of its own, {", ".join(shared_devices)} is configured for '
+                             f'several meters (a meter without a device reads {Reader.DEVICE})')
+
+        if len(self.meters) < 2:
+            return
+
+        portal_meters = {str(config['meter']) for config in self.get_energy_portal_configs()}
+
+        for meter in self.meters:
+            if str(meter['id']) not in portal_meters:
+                self.logger.warning(f'No energy portal receives the readings of meter {meter["id"]}, set "meter" of '
+                                    f'the portal that should receive them')
+
+    def get_readers(self, read_handlers):
+        if self.config.get('replay', {}).get('enabled', False):
+            return [ReplayReader(config=self.config, stop_event=self.stop_reader_event,
+                                 logger=self.create_logger('ReplayReader'), read_handlers=read_handlers)]
+
+        if self.local:
+            return [Mocker(stop_event=self.stop_reader_event, logger=self.create_logger('Mocker'),
+                           read_handlers=read_handlers, config=self.config.get('mocker'))]
+
+        if len(self.meters) == 0:
+            return [Reader(config=self.config, stop_event=self.stop_reader_event, logger=self.create_logger('Reader'),
+                           read_handlers=read_handlers)]
 
-        return self.config['energy_portals']
+        # The solar installation is polled once and shared by the meters it is reported with
+        solar_poller = SolarPoller(config=self.config, stop_event=self.stop_reader_event,
+                                   logger=self.create_logger('SolarPoller'))
+        readers = []
+
+        for meter in self.meters:
+            reader = Reader(config=self.config, stop_event=self.stop_reader_event,
+                            logger=self.create_logger(f'Reader ({meter["id"]})'), read_handlers=read_handlers,
+                            meter=meter, solar_poller=solar_poller if meter.get('solar', False) else None)
+            readers.append(reader)
+
+        return readers
+
+    def create_redis_pusher(self, energy_portal_configs):
+        redis_pusher = RedisPusher(logger=self.create_logger('RedisPusher'),
+                                   queue_names=[config['name'] for config in energy_portal_configs],
+                                   queue_backend=self.queue_backend, queue_encoding=self.queue_encoding,
+                                   queue_meters={config['name']: config['meter'] for config in energy_portal_configs})
+
+        # The scenarios of the mock reader stall Redis by holding up the pusher
+        return fault_injection.StallingReadHandler(redis_pusher) if self.local else redis_pusher
+
+    def create_domoticz_pusher(self):
+        return DomoticzPusher(config=self.config, logger=self.create_logger('DomoticzPusher'),
+                              stop_event=self.stop_reader_event, push_solar=self.push_solar,
+                              meter_id=self.config.get('domoticz_meter', self.default_meter))
 
     def get_senders(self, energy_portal_configs):
         senders = []
 
         for config in energy_portal_configs:
             sender = EnergyPortalSender(stop_event=self.stop_sender_event, config=config,
-                                        logger=self.create_logger(f'EnergyPortalSender ({config["name"]})'))
+                                        logger=self.create_logger(f'EnergyPortalSender ({config["name"]})'),
+                                        queue_backend=self.queue_backend)
+
+            if self.local:
+                fault_injection.simulate_portal_outages(sender)
+
             senders.append(sender)
 
         return senders
 
-    def register_mqtt_publishers(self, read_handlers):
-        mqtt_configs = self.config['mqtt']
+    def get_mqtt_publishers(self):
+        publishers = []
 
-        for config in mqtt_configs:
+        for config in self.config['mqtt']:
             publisher = MqttPublisher(stop_event=self.stop_sender_event, config=config,
-                                        logger=self.create_logger(f'MQTT Publisher ({config["name"]})'))
+                                      logger=self.create_logger(f'MQTT Publisher ({config["name"]})'))
+            publishers.append(publisher)
+
+        return publishers
+
+    def register_mqtt_publishers(self, read_handlers):
+        for publisher in self.get_mqtt_publishers():
             publisher.start()
             read_handlers.append(publisher)
 
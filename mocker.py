@@ -1,30 +1,84 @@
 import logging
 from threading import Thread
-import copy
 import json
 import sys
 import random
 import time
 
+import fault_injection
+from energy_reading import EnergyReading
 from read_handler_interface import ReadHandlerInterface
+from solar_poller import SolarPoller
 from typing import List
 import datetime
 
+SCENARIO_TYPES = ('portal_outage', 'redis_stall', 'solar_timeout')
+
+
+class VirtualMeter(object):
+    """Counters of a simulated meter, they only ever increase."""
+
+    def __init__(self, meter_id, rng: random.Random):
+        self.meter_id = meter_id
+        self.total_usage = rng.randint(1000, 5000)
+        self.total_redelivery = rng.randint(1000, 5000)
+        self.total_solar = rng.randint(1000, 5000)
+        self.total_gas = rng.randint(1000, 5000)
+
 
 class Mocker(Thread):
-    def __init__(self, stop_event, logger: logging.Logger, read_handlers: List[ReadHandlerInterface]):
+    """Generates random readings instead of reading a meter, one every 10 seconds by default.
+
+    As a load generator, the mocker config sets the rate in readings per second, the number of virtual meters the
+    readings are spread over, a seed that makes the generated values reproducible and scenarios that inject faults
+    into the pipeline: [{"type": "portal_outage", "start": 60, "duration": 30, "portal": "example"}, ...]."""
+
+    def __init__(self, stop_event, logger: logging.Logger, read_handlers: List[ReadHandlerInterface],
+                 config: dict = None):
         super().__init__()
 
+        config = config or {}
+        self.check_config(config)
+
         self.daemon = True
         self.logger = logger
 
         self.stop_event = stop_event
         self.default_message = self.get_default_message()
         self.read_handlers: List[ReadHandlerInterface] = read_handlers
-        self.total_usage = random.randint(1000, 5000)
-        self.total_redelivery = random.randint(1000, 5000)
-        self.total_solar = random.randint(1000, 5000)
-        self.total_gas = random.randint(1000, 5000)
+        self.rate = config.get('rate', 0.1)
+        self.random = random.Random(config.get('seed'))
+
+        # A single meter is not tagged, just like a reader without a meters config
+        meter_count = config.get('meters', 1)
+        self.meters = [VirtualMeter(f'mock{index + 1}' if meter_count > 1 else None, self.random)
+                       for index in range(meter_count)]
+
+        scenarios = [scenario for scenario in config.get('scenarios', []) if self.is_valid_scenario(scenario)]
+        self.scenarios = sorted(scenarios, key=lambda scenario: scenario.get('start', 0))
+        self.scenario_index = 0
+
+        # The objects wrapped for the mock setup behave normally unless a mocker has scenarios to run
+        if len(self.scenarios) > 0:
+            fault_injection.enable()
+
+        self.generated = 0
+        self.run_started = None
+        self.next_time = 0
+        self.stats_logged = 0
+        self.stats_generated = 0
+
+    @staticmethod
+    def check_config(config: dict):
+        """Refuse a rate or number of meters the mocker cannot generate readings for."""
+        rate = config.get('rate', 0.1)
+        meter_count = config.get('meters', 1)
+
+        if isinstance(rate, bool) or not isinstance(rate, (int, float)) or rate <= 0:
+            raise ValueError(f'The mocker rate must be a positive number of readings per second, not {rate!r}')
+
+        if isinstance(meter_count, bool) or not isinstance(meter_count, int) or meter_count < 1:
+            raise ValueError(f'The number of mocker meters must be a positive whole number, not {meter_count!r}')
 
     def get_default_message(self):
         try:
@@ -37,71 +91,143 @@ class Mocker(Thread):
         return default_message
 
     def run(self):
-        self.logger.info('Mock reader has been started')
+        self.logger.info(f'Mock reader has been started, generating {self.rate} reading(s) per second for '
+                         f'{len(self.meters)} meter(s)')
 
         while not self.stop_event.is_set():
-            message = self.build_mock_data()
-            self.logger.debug(message)
+            delay = self.get_delay()
 
-            for handler in self.read_handlers:
-                handler.handle_read(message)
+            if delay > 0:
+                self.stop_event.wait(delay)
+                continue
 
-            time.sleep(10)
+            self.emit()
 
         self.logger.info('Mock reader has been stopped')
 
-    def build_mock_data(self):
-        message = copy.deepcopy(self.default_message)
-        energy_data = self.generate_mock_data(message)
+    def get_delay(self) -> float:
+        """Start the scenarios that are due and return how long to wait until the next reading is due."""
+        now = time.time()
+
+        if self.run_started is None:
+            self.run_started = now
+            self.next_time = now
+            self.stats_logged = now
+
+        self.start_scenarios(now - self.run_started)
+
+        if now - self.stats_logged >= 10 and self.rate > 1:
+            self.logger.info(f'Generated {(self.generated - self.stats_generated) / (now - self.stats_logged):.0f} '
+                             f'reading(s) per second')
+            self.stats_logged = now
+            self.stats_generated = self.generated
 
-        return energy_data
+        return self.next_time - now
 
-    def generate_mock_data(self, message):
+    def emit(self):
+        message = self.build_mock_data()
+
+        if self.rate <= 1:
+            self.logger.debug(message)
+
+        for handler in self.read_handlers:
+            handler.handle_read(message)
+
+        self.generated += 1
+
+        # Keep a steady rate, but do not try to catch up more than a second after the handlers held up the mocker
+        self.next_time = max(self.next_time + 1 / self.rate, time.time() - 1)
+
+    def is_valid_scenario(self, scenario) -> bool:
+        if not isinstance(scenario, dict) or scenario.get('type') not in SCENARIO_TYPES:
+            self.logger.warning(f'Skipping scenario {scenario}, its type must be one of {SCENARIO_TYPES}')
+            return False
+
+        for key, default in (('start', 0), ('duration', 60)):
+            value = scenario.get(key, default)
+
+            if isinstance(value, bool) or not isinstance(value, (int, float)) or value < 0:
+                self.logger.warning(f'Skipping scenario {scenario}, its {key} must be a number of seconds')
+                return False
+
+        return True
+
+    def start_scenarios(self, elapsed):
+        while self.scenario_index < len(self.scenarios):
+            scenario = self.scenarios[self.scenario_index]
+
+            if scenario.get('start', 0) > elapsed:
+                return
+
+            duration = scenario.get('duration', 60)
+            target = scenario.get('portal')
+
+            fault_injection.inject(scenario['type'], duration, target=target)
+            self.logger.info(f'Scenario {scenario["type"]} started for {duration}s'
+                             + (f' on {target}' if target is not None else ''))
+            self.scenario_index += 1
+
+    def build_mock_data(self) -> EnergyReading:
+        # The template only holds flat placeholder values, a shallow copy keeps its key order
+        message = dict(self.default_message)
+        meter = self.meters[self.generated % len(self.meters)]
+        energy_data = self.generate_mock_data(message, meter)
+
+        if meter.meter_id is not None:
+            energy_data['meterId'] = meter.meter_id
+
+        return EnergyReading(energy_data)
+
+    def generate_mock_data(self, message, meter: VirtualMeter):
         message["mode"] = 1
 
-        random_decider = random.randint(0, 10000)
+        random_decider = self.random.randint(0, 10000)
 
         if random_decider < 6000:
-            usage = random.randint(0, 2500)
-            self.total_usage = self.total_usage + int(usage / 100)
-            solar = random.randint(0, 2000)
+            usage = self.random.randint(0, 2500)
+            meter.total_usage = meter.total_usage + int(usage / 100)
+            solar = self.random.randint(0, 2000)
             redelivery = 0
         else:
             usage = 0
-            solar = random.randint(0, 4000)
-            redelivery = random.randint(0, solar)
-            self.total_redelivery = self.total_redelivery + int(redelivery / 100)
+            solar = self.random.randint(0, 4000)
+            redelivery = self.random.randint(0, solar)
+            meter.total_redelivery = meter.total_redelivery + int(redelivery / 100)
 
-        self.total_gas = self.total_gas + int(random.randint(0, 110) / 100)
-        solar_data = self.get_solar(solar)
+        meter.total_gas = meter.total_gas + int(self.random.randint(0, 110) / 100)
+        solar_data = self.get_solar(solar, meter)
 
         message["usageNow"] = usage
         message["redeliveryNow"] = redelivery
         message["solarNow"] = int(solar_data['pac'])
-        message["usageTotalHigh"] = self.total_usage
-        message["redeliveryTotalHigh"] = self.total_redelivery
-        message["usageTotalLow"] = self.total_usage
-        message["redeliveryTotalLow"] = self.total_redelivery
+        message["usageTotalHigh"] = meter.total_usage
+        message["redeliveryTotalHigh"] = meter.total_redelivery
+        message["usageTotalLow"] = meter.total_usage
+        message["redeliveryTotalLow"] = meter.total_redelivery
         message["solarTotal"] = int(solar_data['totalEnergy'])
         message["usageGasNow"] = 0
-        message["usageGasTotal"] = self.total_gas
+        message["usageGasTotal"] = meter.total_gas
         message["created"] = datetime.datetime.utcnow().replace(tzinfo=datetime.timezone.utc).isoformat()
         message['allSolar'] = solar_data
 
         return message
 
-    def get_solar(self, solar) -> dict:
-        self.total_solar = self.total_solar + int(solar / 100)
+    def get_solar(self, solar, meter: VirtualMeter) -> dict:
+        # A solar api that times out leaves the reader with an empty sample once the last one is stale
+        if fault_injection.is_active('solar_timeout'):
+            return SolarPoller.empty_sample()
+
+        meter.total_solar = meter.total_solar + int(solar / 100)
 
         solar_data: dict = {
-            'dayEnergy': self.total_solar,
-            'yearEnergy': self.total_solar,
-            'totalEnergy': random.choice([self.total_solar, self.total_solar, self.total_solar, 0]),
+            'dayEnergy': meter.total_solar,
+            'yearEnergy': meter.total_solar,
+            'totalEnergy': meter.total_solar,
             'pac': solar,
-            'udc': int(random.randint(0, 100)),
-            'uac': int(random.randint(0, 100)),
-            'idc': int(random.randint(0, 100)),
-            'iac': int(random.randint(0, 100)),
+            'udc': int(self.random.randint(0, 100)),
+            'uac': int(self.random.randint(0, 100)),
+            'idc': int(self.random.randint(0, 100)),
+            'iac': int(self.random.randint(0, 100)),
         }
 
         return solar_data
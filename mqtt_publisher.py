@@ -2,7 +2,8 @@ import logging
 import paho.mqtt.client as mqtt
 import threading
 import time
-from multiprocessing import Queue
+from queue import Empty, Queue
+from energy_reading import EnergyReading, matches_meter
 from read_handler_interface import ReadHandlerInterface
 from threading import Thread
 
@@ -22,12 +23,25 @@ class MqttPublisher(Thread, ReadHandlerInterface):
         self.mqtt_username = config["username"]
         self.mqtt_password = config["password"]
         self.mqtt_topic = config["topic"]
-        self.connected = False
-
-        self.client = mqtt.Client()
+        self.mqtt_mode = config.get("mode", "topics")
+        self.mqtt_qos = config.get("qos", 0)
+        self.max_pending = config.get("max_pending", 100)
+        # Readings are now delivered without polling delay, so allow for jitter in the 10 second read interval
+        self.min_interval = config.get("min_interval", 9.5)
+        # Only publish the readings of this meter in multi-meter mode, None publishes all meters under their own topic
+        self.meter = config.get("meter")
+        self.time_sent = {}
+
+        # Messages that have been handed to the client but are not yet confirmed by the network loop
+        self.pending = []
+        self.published = 0
+        self.stats_logged = time.time()
+
+        self.client = self.create_client()
 
     def handle_read(self, data: dict) -> None:
-        self.queue.put_nowait(data)
+        if matches_meter(data, self.meter):
+            self.queue.put_nowait(data)
 
     def get_name(self) -> str:
         return f'MqttPublisher {self.mqtt_name}'
@@ -38,47 +52,104 @@ class MqttPublisher(Thread, ReadHandlerInterface):
             return
 
         self.logger.info(f'MQTT Publisher {self.mqtt_name} has been started')
-        time_sent = time.time()
 
         while not self.stop_event.is_set():
             try:
-                if self.queue.empty():
-                    time.sleep(1)
-                    continue
+                data: dict = self.queue.get(timeout=1)
+            except Empty:
+                continue
+
+            while not self.is_connected():
+                if self.stop_event.wait(5):
+                    break
+            else:
+                if not self.is_throttled(data):
+                    self.publish_reading(data)
 
-                if not self.is_connected():
-                    time.sleep(5)
-                    continue
+        self.disconnect()
+        self.logger.info(f'MQTT Publisher {self.mqtt_name} has been terminated')
 
-                # Check if the time since the last message is more than 10 seconds to avoid flooding the MQTT broker
-                if time.time() - time_sent < 10:
-                    while not self.queue.empty():
-                        self.queue.get_nowait()
+    def is_throttled(self, data: dict) -> bool:
+        # Check if the time since the last message of the meter is long enough to avoid flooding the MQTT broker
+        return time.time() - self.time_sent.get(data.get('meterId'), 0) < self.min_interval
 
-                    continue
+    def publish_reading(self, data: dict):
+        if not matches_meter(data, self.meter):
+            return
 
-                data: dict = self.queue.get_nowait()
-                self.publish(self.mqtt_topic, self.mqtt_topic, data)
-                time_sent = time.time()
-            except Exception as e:
-                self.logger.error(f'Failed to push data to MQTT broker {self.mqtt_name}', exc_info=e)
-                self.connected = False
+        self.pending = [message_info for message_info in self.pending if not message_info.is_published()]
+        pending = len(self.pending)
+        self.log_stats(pending)
 
-                try:
-                    self.client.disconnect()
-                except Exception as e:
-                    self.logger.error(f'Failed to disconnect from MQTT broker {self.mqtt_name}', exc_info=e)
+        # Skip the reading instead of queueing ever more messages while the broker is not keeping up
+        if pending >= self.max_pending:
+            self.logger.warning(f'{pending} message(s) to MQTT broker {self.mqtt_name} are not yet confirmed, '
+                                f'skipping reading')
+            return
 
-        self.logger.info(f'MQTT Publisher {self.mqtt_name} has been terminated')
+        reading = EnergyReading.of(data)
+        base_topic = self.mqtt_topic
+
+        # A publisher that receives several meters publishes every meter under its own topic
+        if self.meter is None and reading.meter_id is not None:
+            base_topic = f'{self.mqtt_topic}/{reading.meter_id}'
+
+        try:
+            if self.mqtt_mode in ('json', 'both'):
+                self.publish_message(base_topic, reading.mqtt_json())
+
+            if self.mqtt_mode in ('topics', 'both'):
+                for topic, value in reading.mqtt_values():
+                    self.publish_message(f'{base_topic}/{topic}', value)
+
+            self.time_sent[reading.meter_id] = time.time()
+        except Exception as e:
+            self.logger.error(f'Failed to push data to MQTT broker {self.mqtt_name}', exc_info=e)
+            self.disconnect()
+
+    def log_stats(self, pending):
+        if time.time() - self.stats_logged < 60:
+            return
+
+        self.stats_logged = time.time()
+        self.logger.debug(f'MQTT broker {self.mqtt_name} confirmed {self.published} message(s), {pending} pending')
+
+    def create_client(self) -> mqtt.Client:
+        client = mqtt.Client(mqtt.CallbackAPIVersion.VERSION2)
+        client.on_publish = self.on_publish
+        client.on_disconnect = self.on_disconnect
+
+        return client
+
+    def on_publish(self, client, userdata, mid, reason_code, properties):
+        self.published += 1
+
+    def on_disconnect(self, client, userdata, disconnect_flags, reason_code, properties):
+        if self.connected:
+            self.logger.warning(f'Disconnected from MQTT broker {self.mqtt_name}: {reason_code}')
+
+        self.connected = False
+
+    def disconnect(self):
+        self.connected = False
+
+        try:
+            self.client.disconnect()
+            self.client.loop_stop()
+        except Exception as e:
+            self.logger.error(f'Failed to disconnect from MQTT broker {self.mqtt_name}', exc_info=e)
+
+        self.pending = []
 
     def is_connected(self):
         if self.connected:
             return True
 
         try :
-            self.client = mqtt.Client()
+            self.client = self.create_client()
             self.client.username_pw_set(self.mqtt_username, self.mqtt_password)
             self.client.connect(self.mqtt_host, self.mqtt_port)
+            self.client.loop_start()
             self.connected = True
             return True
         except Exception as e:
@@ -86,22 +157,11 @@ class MqttPublisher(Thread, ReadHandlerInterface):
 
         return False
 
-    def publish(self, topic, parent_key, value):
-        # Check if value is a dictionary
-        if isinstance(value, dict):
-            for key, value in value.items():
-                self.publish(topic + '/' + key, key, value)
-        else:
-            if parent_key == 'usageGasTotal':
-                float_value = float(value)
-                float_value = float_value / 1000
-                self.client.publish(topic, float(float_value))
-                return
-
-            # Check if value is a float
-            if isinstance(value, float):
-                self.client.publish(topic, float(value))
-            elif isinstance(value, int):
-                self.client.publish(topic, int(value))
-            else:
-                self.client.publish(topic, str(value))
\ No newline at end of file
+    def publish_message(self, topic, payload):
+        message_info = self.client.publish(topic, payload, qos=self.mqtt_qos)
+
+        if message_info.rc != mqtt.MQTT_ERR_SUCCESS:
+            raise Exception(f'Failed to publish to {topic}: {mqtt.error_string(message_info.rc)}')
+
+        # QoS 0 messages are confirmed once written to the socket, for higher QoS once acknowledged by the broker
+        self.pending.append(message_info)
@@ -0,0 +1,118 @@
+import socket
+from typing import List
+
+from redis_queue import RedisQueue
+from redis_stream_queue import RedisStreamQueue
+from sqlite_queue import SqliteQueue
+
+READINGS_STREAM = 'readings'
+
+
+def get_stream_group(portal_name) -> str:
+    return f'portal_{portal_name}'
+
+
+class ListPortalQueue:
+    """Portal queue on lists: every portal has its own normal, retry and dead letter list.
+
+    The lists are kept in Redis, or in the SQLite spool when queue_class is SqliteQueue."""
+
+    def __init__(self, portal_name, queue_class=RedisQueue):
+        self.normal_data_queue = queue_class(f'normal_{portal_name}')
+        self.retry_data_queue = queue_class(f'retry_{portal_name}')
+        self.dead_letter_queue = queue_class(f'dead_{portal_name}')
+        self.dead_letter_key = self.dead_letter_queue.key
+
+    def get_retry(self, n, worker=0) -> List[bytes]:
+        return self.retry_data_queue.get_many(n)
+
+    def get_new(self, n, wait_timeout=0, worker=0) -> List[bytes]:
+        normal_messages = self.normal_data_queue.get_many(n)
+
+        if len(normal_messages) == 0 and wait_timeout > 0:
+            # BLPOP only takes whole seconds before Redis 6, and 0 would block forever
+            first_message = self.normal_data_queue.get(timeout=max(1, int(wait_timeout)))
+
+            if first_message is None:
+                return []
+
+            normal_messages = [first_message] + self.normal_data_queue.get_many(n - 1)
+
+        return normal_messages
+
+    def ack(self, messages: List[bytes]):
+        # Messages are removed from the lists when they are read
+        pass
+
+    def requeue(self, messages: List[bytes]):
+        self.retry_data_queue.put_many_front(messages)
+
+    def dead_letter(self, message: bytes):
+        self.dead_letter_queue.put(message)
+
+
+class StreamPortalQueue:
+    """Portal queue on the shared readings stream, with one consumer group per portal.
+
+    Every sender worker reads as its own consumer, so the entries it fails to send stay pending for it and are read
+    again before new entries. Entries left pending by a consumer that went away are claimed after claim_idle_time ms."""
+
+    def __init__(self, portal_name, claim_idle_time=60000, meter=None):
+        # Meter ids are read from the stream as strings, while the config may hold numbers
+        self.meter = str(meter) if meter is not None else None
+        self.stream = RedisStreamQueue(READINGS_STREAM)
+        self.dead_letter_stream = RedisStreamQueue(f'dead_{portal_name}')
+        self.dead_letter_key = self.dead_letter_stream.key
+        self.group = get_stream_group(portal_name)
+        self.claim_idle_time = claim_idle_time
+        self.stream.create_group(self.group)
+
+    @staticmethod
+    def get_consumer(worker) -> str:
+        # Consumer names belong to a sender worker and are stable across restarts, so a worker picks up its own
+        # pending entries, whichever thread it runs on
+        return f'{socket.gethostname()}-{worker + 1}'
+
+    def get_retry(self, n, worker=0) -> List[bytes]:
+        consumer = self.get_consumer(worker)
+        messages = self.stream.get_pending(self.group, consumer, n)
+
+        if len(messages) == 0:
+            messages = self.stream.claim(self.group, consumer, self.claim_idle_time, n)
+
+        return self.filter_meter(messages)
+
+    def get_new(self, n, wait_timeout=0, worker=0) -> List[bytes]:
+        return self.filter_meter(self.stream.get_many(self.group, self.get_consumer(worker), n, wait_timeout))
+
+    def filter_meter(self, messages: List[bytes]) -> List[bytes]:
+        # All meters share the readings stream, the entries of other meters are acknowledged without sending them
+        if self.meter is None:
+            return messages
+
+        matching = [message for message in messages if message.meter in (None, self.meter)]
+        self.ack([message for message in messages if message.meter not in (None, self.meter)])
+
+        return matching
+
+    def ack(self, messages: List[bytes]):
+        self.stream.ack(self.group, [message.id for message in messages])
+
+    def requeue(self, messages: List[bytes]):
+        # Unacknowledged entries stay pending for this consumer and are read again first
+        pass
+
+    def dead_letter(self, message: bytes):
+        self.dead_letter_stream.put(message)
+        self.ack([message])
+
+
+def create_portal_queue(queue_backend, portal_name, config: dict):
+    if queue_backend == 'streams':
+        return StreamPortalQueue(portal_name, claim_idle_time=config.get('claim_idle_time', 60000),
+                                 meter=config.get('meter'))
+
+    if queue_backend == 'spool':
+        return ListPortalQueue(portal_name, queue_class=SqliteQueue)
+
+    return ListPortalQueue(portal_name)
@@ -0,0 +1,48 @@
+class RunningStats:
+    """Incremental min/max/mean over a stream of values, using constant memory."""
+
+    def __init__(self):
+        self.count = 0
+        self.minimum = 0
+        self.maximum = 0
+        self.mean = 0.0
+
+    def add(self, value):
+        if self.count == 0:
+            self.minimum = value
+            self.maximum = value
+        else:
+            self.minimum = min(self.minimum, value)
+            self.maximum = max(self.maximum, value)
+
+        self.count += 1
+        self.mean += (value - self.mean) / self.count
+
+
+class PowerAggregator:
+    """Folds the instantaneous power of every telegram within a read interval into one aggregated value."""
+
+    def __init__(self):
+        self.usage = RunningStats()
+        self.redelivery = RunningStats()
+
+    def add(self, usage: int, redelivery: int):
+        self.usage.add(usage)
+        self.redelivery.add(redelivery)
+
+    def apply(self, data: dict):
+        """Replace the instantaneous power in data by the interval mean, add the statistics and start a new interval."""
+        if self.usage.count > 0:
+            data['usageNow'] = round(self.usage.mean)
+            data['redeliveryNow'] = round(self.redelivery.mean)
+
+        data['powerStats'] = {
+            'samples': self.usage.count,
+            'usageMin': self.usage.minimum,
+            'usageMax': self.usage.maximum,
+            'redeliveryMin': self.redelivery.minimum,
+            'redeliveryMax': self.redelivery.maximum,
+        }
+
+        self.usage = RunningStats()
+        self.redelivery = RunningStats()
@@ -0,0 +1,121 @@
+import logging
+import queue
+import threading
+import time
+from typing import List
+
+from enums import OverflowPolicy
+from read_handler_interface import ReadHandlerInterface
+
+
+class HandlerWorker(threading.Thread, ReadHandlerInterface):
+    """Feeds a single read handler from its own bounded queue, so a slow handler never stalls the reader."""
+
+    def __init__(self, handler: ReadHandlerInterface, stop_event: threading.Event, logger: logging.Logger,
+                 max_size: int, overflow_policy: OverflowPolicy):
+        super().__init__()
+
+        self.daemon = True
+        self.handler = handler
+        self.stop_event = stop_event
+        self.logger = logger
+        self.overflow_policy = overflow_policy
+        self.queue: queue.Queue = queue.Queue(maxsize=max_size)
+        self.delivered = 0
+        self.dropped = 0
+        self.failed = 0
+        self.last_drop_warning = 0
+
+    def handle_read(self, data: dict) -> None:
+        if self.overflow_policy == OverflowPolicy.BLOCK:
+            while not self.stop_event.is_set():
+                try:
+                    self.queue.put(data, timeout=1)
+                    return
+                except queue.Full:
+                    continue
+
+            return
+
+        try:
+            self.queue.put_nowait(data)
+            return
+        except queue.Full:
+            pass
+
+        if self.overflow_policy == OverflowPolicy.DROP_OLDEST:
+            try:
+                self.queue.get_nowait()
+            except queue.Empty:
+                pass
+
+            try:
+                self.queue.put_nowait(data)
+            except queue.Full:
+                pass
+
+        self.register_drop()
+
+    def register_drop(self):
+        self.dropped += 1
+
+        if time.time() - self.last_drop_warning >= 60:
+            self.last_drop_warning = time.time()
+            self.logger.warning(f'Read handler {self.get_name()} cannot keep up, {self.dropped} reading(s) dropped '
+                                f'so far')
+
+    def get_name(self) -> str:
+        return self.handler.get_name()
+
+    def get_stats(self) -> dict:
+        return {
+            'name': self.get_name(),
+            'depth': self.queue.qsize(),
+            'delivered': self.delivered,
+            'dropped': self.dropped,
+            'failed': self.failed,
+        }
+
+    def run(self):
+        while not self.stop_event.is_set():
+            try:
+                data = self.queue.get(timeout=1)
+            except queue.Empty:
+                continue
+
+            try:
+                self.handler.handle_read(data)
+                self.delivered += 1
+            except Exception as e:
+                self.failed += 1
+                self.logger.error(f'Failed to push data to read handler {self.get_name()}', exc_info=e)
+
+
+class ReadDispatcher:
+    """Wraps read handlers in workers with bounded queues.
+
+    The queue size and overflow policy are read from the "dispatch" section of the config and can be overridden per
+    handler name."""
+
+    def __init__(self, config: dict, stop_event: threading.Event, logger: logging.Logger):
+        self.config = config.get('dispatch', {})
+        self.stop_event = stop_event
+        self.logger = logger
+        self.workers: List[HandlerWorker] = []
+
+    def wrap(self, handlers: List[ReadHandlerInterface]) -> List[ReadHandlerInterface]:
+        for handler in handlers:
+            handler_config = self.config.get('handlers', {}).get(handler.get_name(), {})
+            max_size = handler_config.get('queue_size', self.config.get('queue_size', 100))
+            overflow_policy = OverflowPolicy(handler_config.get('overflow_policy',
+                                                                self.config.get('overflow_policy', 'drop_oldest')))
+
+            worker = HandlerWorker(handler=handler, stop_event=self.stop_event, logger=self.logger,
+                                   max_size=max_size, overflow_policy=overflow_policy)
+            worker.start()
+            self.workers.append(worker)
+
+        return list(self.workers)
+
+    def get_stats(self) -> List[dict]:
+        return [worker.get_stats() for worker in self.workers]
@@ -1,134 +1,203 @@
 import datetime
 import logging
+import os
 import threading
 import time
-import requests
+import serial
 from dsmr_parser import telegram_specifications
-from dsmr_parser.clients import SerialReader, SERIAL_SETTINGS_V4
+from dsmr_parser.clients import SerialReader, SERIAL_SETTINGS_V2_2, SERIAL_SETTINGS_V4, SERIAL_SETTINGS_V5
 from dsmr_parser import obis_references
+from dsmr_parser.exceptions import InvalidChecksumError, ParseError
 from typing import List
 
+from energy_reading import EnergyReading
+from fast_telegram_parser import FastTelegramParser
+from power_aggregator import PowerAggregator
 from read_handler_interface import ReadHandlerInterface
-from redis_queue import RedisQueue
+from solar_poller import SolarPoller
+from telegram_capture import TelegramCapture
 
 
 class Reader(threading.Thread):
+    DEVICE = '/dev/ttyUSB0'
+    DSMR_VERSIONS = {
+        '2.2': (SERIAL_SETTINGS_V2_2, telegram_specifications.V2_2),
+        '4': (SERIAL_SETTINGS_V4, telegram_specifications.V4),
+        '5': (SERIAL_SETTINGS_V5, telegram_specifications.V5),
+    }
+
     def __init__(self, config: dict, stop_event: threading.Event, logger: logging.Logger,
-                 read_handlers: List[ReadHandlerInterface]):
+                 read_handlers: List[ReadHandlerInterface], meter: dict = None, solar_poller: SolarPoller = None):
+        """Read a single meter. Without a meter config, the default device is read and readings are not tagged.
+
+        In multi-meter mode the solar poller is shared, and only given to the meters that report solar."""
         super().__init__()
 
         self.daemon = True
         self.logger: logging.Logger = logger
         self.read_handlers: List[ReadHandlerInterface] = read_handlers
 
-        self.energy_data_queue = RedisQueue('normal')
+        self.meter_id = meter['id'] if meter is not None else None
+        self.device = meter.get('device', Reader.DEVICE) if meter is not None else Reader.DEVICE
+        self.dsmr_version = str(meter.get('dsmr_version', '4')) if meter is not None else '4'
         self.reader = self.init_reader()
-        self.solar_ip = config['solar_ip']
-        self.solar_url = self.solar_ip + config['solar_url']
         self.stop_event = stop_event
+
+        # The fast parser reads the values of DSMR 4 and up, DSMR 2.2 telegrams are always parsed by dsmr_parser
+        use_fast_parser = config.get('parser', 'dsmr_parser') == 'fast' and self.dsmr_version != '2.2'
+        self.fast_parser = FastTelegramParser() if use_fast_parser else None
+        self.capture = self.init_capture(config.get('capture'))
+
+        if meter is None:
+            solar_poller = SolarPoller(config=config, stop_event=stop_event, logger=logger.getChild('SolarPoller'))
+
+        self.solar_poller = solar_poller
         self.debug = True if config["debug"] == "true" else False
+        self.read_interval = config.get('read_interval', 10)
+        self.aggregator = PowerAggregator()
         self.last_read_time = 0
 
-    @staticmethod
-    def init_reader():
+    def init_reader(self):
+        serial_settings, telegram_specification = Reader.DSMR_VERSIONS[self.dsmr_version]
+        # SerialReader stores the device in the settings, so every reader needs its own copy
         serial_reader = SerialReader(
-            device="/dev/ttyUSB0",
-            serial_settings=SERIAL_SETTINGS_V4,
-            telegram_specification=telegram_specifications.V4
+            device=self.device,
+            serial_settings=dict(serial_settings),
+            telegram_specification=telegram_specification
         )
 
         return serial_reader
 
+    def init_capture(self, capture_config: dict or None) -> TelegramCapture or None:
+        if not capture_config or not capture_config.get('enabled', False):
+            return None
+
+        file_name = capture_config.get('file', 'telegrams.capture.gz')
+
+        # Every meter is captured to a file of its own
+        if self.meter_id is not None:
+            root, extension = os.path.splitext(file_name)
+            file_name = f'{root}_{self.meter_id}{extension}'
+
+        return TelegramCapture(file_name, max_bytes=capture_config.get('max_bytes', 10485760),
+                               backup_count=capture_config.get('backup_count', 5),
+                               flush_interval=capture_config.get('flush_interval', 60))
+
     def run(self):
         self.logger.info('Reader has been started')
+
+        if self.solar_poller is not None:
+            self.solar_poller.start()
+
         self.read()
 
     def read(self):
-        for telegram in self.reader.read():
-            actual_read_time = time.time()
-
-            # Only read every 10 seconds
-            if actual_read_time - self.last_read_time < 9.8:
-                continue
+        try:
+            for received, telegram in self.read_telegrams():
+                try:
+                    values = self.parse(telegram, received)
+                except InvalidChecksumError as e:
+                    self.logger.warning(str(e))
+                    continue
+                except ParseError as e:
+                    self.logger.error(f'Failed to parse telegram: {e}')
+                    continue
+
+                self.handle_values(values, received)
+
+                if self.stop_event.is_set():
+                    break
+        finally:
+            if self.capture is not None:
+                self.capture.close()
 
-            self.last_read_time = actual_read_time
+        self.logger.info('Reader has been stopped')
 
-            energy_data = self.extract_data_from_telegram(telegram)
-            self.logger.debug(energy_data)
+    def read_telegrams(self):
+        """Yield the (receive time, raw telegram) pairs read from the serial port."""
+        with serial.Serial(**self.reader.serial_settings) as serial_handle:
+            while True:
+                data = serial_handle.read(max(1, min(1024, serial_handle.in_waiting)))
+                self.reader.telegram_buffer.append(data.decode('ascii'))
 
-            for read_handler in self.read_handlers:
-                name: str = 'Unknown'
+                for telegram in self.reader.telegram_buffer.get_all():
+                    yield time.time(), telegram
 
-                try:
-                    name = read_handler.get_name()
-                    read_handler.handle_read(energy_data)
-                except Exception:
-                    self.logger.error(f'Failed to push data to read handler {name}')
+    def parse(self, telegram: str, received: float = None) -> dict:
+        """Capture the raw telegram if enabled and return its values.
 
-            if self.stop_event.is_set():
-                break
+        This is also the telegram parser of the asyncio protocol, so it raises the exceptions of dsmr_parser."""
+        if self.capture is not None:
+            try:
+                self.capture.write(telegram, received)
+            except Exception as e:
+                self.logger.error('Failed to capture telegram', exc_info=e)
+                self.capture = None
 
-        self.logger.info('Reader has been stopped')
+        if self.fast_parser is not None:
+            return self.fast_parser.parse(telegram)
 
-    def extract_data_from_telegram(self, telegram):
-        solar = self.read_solar()
+        return self.telegram_values(self.reader.telegram_parser.parse(telegram))
 
-        data = {
+    @staticmethod
+    def telegram_values(telegram) -> dict:
+        """Return the values of a telegram parsed by dsmr_parser, as ints in the units of the fast parser."""
+        return {
             'mode': int(telegram[obis_references.ELECTRICITY_ACTIVE_TARIFF].value),
             'usageNow': int(telegram[obis_references.CURRENT_ELECTRICITY_USAGE].value * 1000),
             'redeliveryNow': int(telegram[obis_references.CURRENT_ELECTRICITY_DELIVERY].value * 1000),
-            'solarNow': int(solar['pac']),
             'usageTotalHigh': int(telegram[obis_references.ELECTRICITY_USED_TARIFF_2].value * 1000),
             'redeliveryTotalHigh': int(telegram[obis_references.ELECTRICITY_DELIVERED_TARIFF_2].value * 1000),
             'usageTotalLow': int(telegram[obis_references.ELECTRICITY_USED_TARIFF_1].value * 1000),
             'redeliveryTotalLow': int(telegram[obis_references.ELECTRICITY_DELIVERED_TARIFF_1].value * 1000),
+            'usageGasTotal': int(telegram[obis_references.HOURLY_GAS_METER_READING].value * 1000),
+        }
+
+    def handle_values(self, values: dict, received: float = None):
+        actual_read_time = received or time.time()
+
+        self.aggregator.add(values['usageNow'], values['redeliveryNow'])
+
+        # Only emit one aggregated reading per interval, allow some jitter in the telegram timing
+        if actual_read_time - self.last_read_time < self.read_interval - 0.2:
+            return
+
+        self.last_read_time = actual_read_time
+
+        energy_data = self.extract_data(values, actual_read_time)
+        self.logger.debug(energy_data)
+
+        for read_handler in self.read_handlers:
+            name: str = 'Unknown'
+
+            try:
+                name = read_handler.get_name()
+                read_handler.handle_read(energy_data)
+            except Exception:
+                self.logger.error(f'Failed to push data to read handler {name}')
+
+    def extract_data(self, values: dict, received: float) -> EnergyReading:
+        solar = self.solar_poller.get_solar() if self.solar_poller is not None else SolarPoller.empty_sample()
+
+        data = {
+            'mode': values['mode'],
+            'usageNow': values['usageNow'],
+            'redeliveryNow': values['redeliveryNow'],
+            'solarNow': int(solar['pac']),
+            'usageTotalHigh': values['usageTotalHigh'],
+            'redeliveryTotalHigh': values['redeliveryTotalHigh'],
+            'usageTotalLow': values['usageTotalLow'],
+            'redeliveryTotalLow': values['redeliveryTotalLow'],
             'solarTotal': int(solar['totalEnergy']),
             'usageGasNow': 0,
-            'usageGasTotal': int(telegram[obis_references.HOURLY_GAS_METER_READING].value * 1000),
-            'created': datetime.datetime.utcnow().replace(tzinfo=datetime.timezone.utc).isoformat(),
+            'usageGasTotal': values['usageGasTotal'],
+            'created': datetime.datetime.fromtimestamp(received, tz=datetime.timezone.utc).isoformat(),
             'allSolar': solar
         }
 
-        return data
-
-    def read_solar(self, retry=False):
-        solar = {
-            'pac': 0,
-            'dayEnergy': 0,
-            'yearEnergy': 0,
-            'totalEnergy': 0,
-            'udc': 0,
-            'uac': 0,
-            'idc': 0,
-            'iac': 0,
-        }
+        self.aggregator.apply(data)
 
-        if str(self.solar_ip) == "":
-            return solar
+        if self.meter_id is not None:
+            data['meterId'] = self.meter_id
 
-        try:
-            time.sleep(0.85)
-            solar_data = requests.get(url=self.solar_url, timeout=2).json()['Body']['Data']
-            solar['dayEnergy'] = solar_data['DAY_ENERGY']['Value']
-            solar['yearEnergy'] = solar_data['YEAR_ENERGY']['Value']
-            solar['totalEnergy'] = solar_data['TOTAL_ENERGY']['Value']
-
-            if 'PAC' not in solar_data:
-                return solar
-
-            solar['pac'] = solar_data['PAC']['Value']
-            solar['udc'] = solar_data['UDC']['Value']
-            solar['uac'] = solar_data['UAC']['Value']
-            solar['idc'] = solar_data['IDC']['Value']
-            solar['iac'] = solar_data['IAC']['Value']
-
-            return solar
-        except requests.exceptions.ConnectTimeout:
-            return solar
-        except Exception as e:
-            if not retry:
-                solar = self.read_solar(True)
-            else:
-                self.logger.error('Could not read data from solar api: {}'.format(self.solar_url), exc_info=e)
-
-            return solar
+        return EnergyReading(data)
@@ -0,0 +1,51 @@
+import datetime
+import json
+import struct
+
+# Readings are encoded as a version byte followed by a fixed layout of the fields below. JSON messages start with '{',
+# so both encodings can be mixed in one queue.
+COMPACT_VERSION = 1
+
+FIELDS = [
+    ('mode', 'b'),
+    ('usageNow', 'i'),
+    ('redeliveryNow', 'i'),
+    ('solarNow', 'i'),
+    ('usageTotalHigh', 'q'),
+    ('redeliveryTotalHigh', 'q'),
+    ('usageTotalLow', 'q'),
+    ('redeliveryTotalLow', 'q'),
+    ('solarTotal', 'q'),
+    ('usageGasNow', 'i'),
+    ('usageGasTotal', 'q'),
+]
+
+LAYOUT = struct.Struct('<B' + ''.join(field_format for _, field_format in FIELDS) + 'q')
+FIELD_NAMES = {name for name, _ in FIELDS} | {'created'}
+EPOCH = datetime.datetime(1970, 1, 1, tzinfo=datetime.timezone.utc)
+
+
+def encode(data: dict) -> bytes:
+    """Encode a reading in the compact layout, or as JSON when it does not fit the layout."""
+    if set(data.keys()) != FIELD_NAMES:
+        return json.dumps(data).encode('utf-8')
+
+    try:
+        created = datetime.datetime.fromisoformat(data['created'])
+        values = [int(data[name]) for name, _ in FIELDS]
+
+        return LAYOUT.pack(COMPACT_VERSION, *values, (created - EPOCH) // datetime.timedelta(microseconds=1))
+    except (ValueError, TypeError, struct.error):
+        return json.dumps(data).encode('utf-8')
+
+
+def decode(message: bytes) -> bytes:
+    """Return the reading in message as JSON, whichever encoding it was queued in."""
+    if message[:1] != bytes([COMPACT_VERSION]):
+        return message
+
+    values = LAYOUT.unpack(message)
+    data = {name: value for (name, _), value in zip(FIELDS, values[1:-1])}
+    data['created'] = (EPOCH + datetime.timedelta(microseconds=values[-1])).isoformat()
+
+    return json.dumps(data).encode('utf-8')
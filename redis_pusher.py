@@ -1,29 +1,96 @@
-import copy
-import json
 import logging
 
+from energy_reading import EnergyReading, matches_meter
+
 from read_handler_interface import ReadHandlerInterface
-from redis_queue import RedisQueue
+from portal_queue import READINGS_STREAM, get_stream_group
+from redis_queue import RedisQueue, get_client
+from redis_stream_queue import RedisStreamQueue
+from sqlite_queue import SqliteQueue, get_spool
 
 
 class RedisPusher(ReadHandlerInterface):
-    def __init__(self, logger: logging.Logger, queue_names):
+    def __init__(self, logger: logging.Logger, queue_names, queue_backend='lists', queue_encoding='json',
+                 trim_interval=60, queue_meters: dict = None):
+        """queue_meters maps a queue name to the meter its portal is routed to, all meters go to the other queues."""
         self.redis_queues = []
+        self.queue_meters = {}
+        self.stream = None
+        self.spool = None
+        self.stream_groups = [get_stream_group(queue_name) for queue_name in queue_names]
+        self.trim_interval = trim_interval
+        self.compact = queue_encoding == 'compact'
+        self.pushed = 0
+
+        if queue_backend == 'streams':
+            # One stream for all portals, every portal reads it through its own consumer group
+            self.stream = RedisStreamQueue(READINGS_STREAM)
+
+            for group in self.stream_groups:
+                self.stream.create_group(group)
+        elif queue_backend == 'spool':
+            self.spool = get_spool()
+
+            for queue_name in queue_names:
+                self.redis_queues.append(SqliteQueue(f'normal_{queue_name}'))
+        else:
+            for queue_name in queue_names:
+                self.redis_queues.append(RedisQueue(f'normal_{queue_name}'))
 
-        for queue_name in queue_names:
-            self.redis_queues.append(RedisQueue(f'normal_{queue_name}'))
+        for queue_name, redis_queue in zip(queue_names, self.redis_queues):
+            self.queue_meters[redis_queue.key] = (queue_meters or {}).get(queue_name)
 
+        self.client = get_client() if self.spool is None else None
         self.logger: logging.Logger = logger
 
     def handle_read(self, data: dict) -> None:
-        energy_data = copy.deepcopy(data)
-        energy_data.pop('allSolar')
-
-        for redis_queue in self.redis_queues:
-            try:
-                redis_queue.put(json.dumps(energy_data))
-            except Exception as e:
-                self.logger.error(f'Failed to put data in redis queue ({redis_queue.key})', exc_info=e)
+        reading = EnergyReading.of(data)
+        message = reading.portal_compact() if self.compact else reading.portal_json()
+
+        if self.stream is not None:
+            self.push_to_stream(message, reading.meter_id)
+            return
+
+        redis_queues = [redis_queue for redis_queue in self.redis_queues
+                        if matches_meter(reading, self.queue_meters[redis_queue.key])]
+
+        if self.spool is not None:
+            self.push_to_spool(message, redis_queues)
+            return
+
+        # Push to all portal queues in a single round trip
+        pipeline = self.client.pipeline(transaction=False)
+
+        for redis_queue in redis_queues:
+            pipeline.rpush(redis_queue.key, message)
+
+        try:
+            results = pipeline.execute(raise_on_error=False)
+        except Exception as e:
+            self.logger.error('Failed to put data in redis queues', exc_info=e)
+            return
+
+        for redis_queue, result in zip(redis_queues, results):
+            if isinstance(result, Exception):
+                self.logger.error(f'Failed to put data in redis queue ({redis_queue.key})', exc_info=result)
+
+    def push_to_stream(self, message, meter_id=None):
+        try:
+            self.stream.put(message, meter_id)
+            self.pushed += 1
+
+            # Drop the entries all portals have acknowledged every now and then
+            if self.pushed % self.trim_interval == 0:
+                self.stream.trim(self.stream_groups)
+        except Exception as e:
+            self.logger.error(f'Failed to put data in redis stream ({self.stream.key})', exc_info=e)
+
+    def push_to_spool(self, message, redis_queues):
+        try:
+            # Append to all portal queues in a single transaction
+            self.spool.put_many([(queue.key, message) for queue in redis_queues])
+        except Exception as e:
+            self.logger.error('Failed to put data in spool queues', exc_info=e)
 
     def get_name(self) -> str:
         return 'RedisPusher'
@@ -1,12 +1,57 @@
+import threading
+
 import redis
 
+_connection_pool = None
+# Replaces the head of a list, but only when its first and last item are still the ones that were read: ARGV holds
+# the number of items to replace, the first and last of them and then the items to put in their place
+REPLACE_HEAD_SCRIPT = """
+local size = tonumber(ARGV[1])
+if redis.call('LINDEX', KEYS[1], 0) ~= ARGV[2] or redis.call('LINDEX', KEYS[1], size - 1) ~= ARGV[3] then
+    return 0
+end
+redis.call('LTRIM', KEYS[1], size, -1)
+for i = #ARGV, 4, -1 do
+    redis.call('LPUSH', KEYS[1], ARGV[i])
+end
+return 1
+"""
+_connection_pool_lock = threading.Lock()
+
+
+def get_connection_pool():
+    """Return the process-wide connection pool shared by all queues.
+
+    The pool is created on first use with the default connection parameters: host='localhost', port=6379, db=0"""
+    global _connection_pool
+
+    with _connection_pool_lock:
+        if _connection_pool is None:
+            _connection_pool = redis.ConnectionPool()
+
+        return _connection_pool
+
+
+def get_client():
+    """Return a Redis client that uses the process-wide connection pool."""
+    return redis.Redis(connection_pool=get_connection_pool())
+
 
 class RedisQueue(object):
     """Simple Queue with Redis Backend"""
-    def __init__(self, name, namespace='queue', **redis_kwargs):
-        """The default connection parameters are: host='localhost', port=6379, db=0"""
-        self.__db= redis.Redis(**redis_kwargs)
+    def __init__(self, name, namespace='queue', connection_pool=None, **redis_kwargs):
+        """Use the given connection pool, or the process-wide pool when neither a pool nor connection parameters
+        are given. The default connection parameters are: host='localhost', port=6379, db=0"""
+        if connection_pool is None and not redis_kwargs:
+            connection_pool = get_connection_pool()
+
+        if connection_pool is not None:
+            self.__db = redis.Redis(connection_pool=connection_pool)
+        else:
+            self.__db = redis.Redis(**redis_kwargs)
+
         self.key = '%s:%s' %(namespace, name)
+        self.replace_head_script = self.__db.register_script(REPLACE_HEAD_SCRIPT)
 
     def qsize(self):
         """Return the approximate size of the queue."""
@@ -20,6 +65,11 @@ class RedisQueue(object):
         """Put item into the queue."""
         self.__db.rpush(self.key, item)
 
+    def put_many_front(self, items):
+        """Put items back at the head of the queue in a single call, preserving their order."""
+        if len(items) > 0:
+            self.__db.lpush(self.key, *reversed(items))
+
     def get(self, block=True, timeout=None):
         """Remove and return an item from the queue.
 
@@ -37,3 +87,35 @@ class RedisQueue(object):
     def get_nowait(self):
         """Equivalent to get(False)."""
         return self.get(False)
+
+    def get_many(self, n):
+        """Remove and return up to n items from the head of the queue.
+
+        The read and the trim are executed in a single MULTI/EXEC transaction, so the batch is fetched in one round
+        trip and no other consumer can receive the same items."""
+        if n <= 0:
+            return []
+
+        pipe = self.__db.pipeline(transaction=True)
+        pipe.lrange(self.key, 0, n - 1)
+        pipe.ltrim(self.key, n, -1)
+        items, _ = pipe.execute()
+
+        return items
+
+    def peek_many(self, n):
+        """Return up to n items from the head of the queue without removing them."""
+        if n <= 0:
+            return []
+
+        return self.__db.lrange(self.key, 0, n - 1)
+
+    def replace_head(self, old_items, new_items) -> bool:
+        """Replace old_items, read from the head of the queue with peek_many, by new_items in one atomic step.
+
+        Returns False, leaving the queue untouched, when a consumer took items from the head in the meantime."""
+        if len(old_items) == 0:
+            return True
+
+        return self.replace_head_script(keys=[self.key],
+                                        args=[len(old_items), old_items[0], old_items[-1]] + list(new_items)) == 1
@@ -0,0 +1,124 @@
+import redis
+
+from redis_queue import get_connection_pool
+
+
+class StreamMessage(bytes):
+    """Message read from a stream, carrying the id of its stream entry."""
+
+
+def to_message(entry_id, fields: dict) -> StreamMessage:
+    message = StreamMessage(fields[b'data'])
+    message.id = entry_id
+    message.meter = fields[b'meter'].decode('utf-8') if b'meter' in fields else None
+
+    return message
+
+
+def parse_stream_id(entry_id) -> tuple:
+    if isinstance(entry_id, bytes):
+        entry_id = entry_id.decode('utf-8')
+
+    milliseconds, sequence = entry_id.split('-')
+
+    return int(milliseconds), int(sequence)
+
+
+class RedisStreamQueue(object):
+    """Queue with a Redis Streams backend.
+
+    Every consumer group receives every entry once, and an entry stays pending for its consumer until it is
+    acknowledged."""
+    def __init__(self, name, namespace='stream', connection_pool=None):
+        self.__db = redis.Redis(connection_pool=connection_pool or get_connection_pool())
+        self.key = '%s:%s' % (namespace, name)
+
+    def put(self, item, meter=None):
+        """Append item to the stream, tagged with the meter it was read from if given."""
+        fields = {'data': item}
+
+        if meter is not None:
+            fields['meter'] = meter
+
+        self.__db.xadd(self.key, fields)
+
+    def create_group(self, group):
+        """Create the consumer group, starting at the beginning of the stream, if it does not exist yet."""
+        try:
+            self.__db.xgroup_create(self.key, group, id='0', mkstream=True)
+        except redis.exceptions.ResponseError as e:
+            if 'BUSYGROUP' not in str(e):
+                raise
+
+    def get_pending(self, group, consumer, n):
+        """Return up to n entries that were delivered to this consumer but not yet acknowledged, oldest first."""
+        return self.read_group(group, consumer, '0', n)
+
+    def get_many(self, group, consumer, n, timeout=0):
+        """Return up to n entries that were never delivered to the group.
+
+        If timeout is larger than zero, block up to timeout seconds until an entry is available."""
+        return self.read_group(group, consumer, '>', n, block=int(timeout * 1000) if timeout > 0 else None)
+
+    def read_group(self, group, consumer, entry_id, n, block=None):
+        response = self.__db.xreadgroup(group, consumer, {self.key: entry_id}, count=n, block=block)
+
+        if not response:
+            return []
+
+        # Pending entries that were deleted from the stream come back without fields, acknowledge them so they are
+        # not read again
+        self.ack(group, [entry_id for entry_id, fields in response[0][1] if not fields])
+
+        return [to_message(entry_id, fields) for entry_id, fields in response[0][1] if fields]
+
+    def claim(self, group, consumer, min_idle_time, n):
+        """Take over up to n entries that have been pending for other consumers for at least min_idle_time ms."""
+        response = self.__db.execute_command('XAUTOCLAIM', self.key, group, consumer, min_idle_time, '0-0',
+                                             'COUNT', n)
+        messages = []
+        deleted = []
+
+        for entry in response[1]:
+            if entry is None:
+                continue
+
+            if entry[1] is None:
+                deleted.append(entry[0])
+                continue
+
+            fields = dict(zip(entry[1][::2], entry[1][1::2]))
+            messages.append(to_message(entry[0], fields))
+
+        # Entries that were deleted while pending are acknowledged, otherwise they would be claimed over and over
+        self.ack(group, deleted)
+
+        return messages
+
+    def ack(self, group, entry_ids):
+        """Acknowledge the entries, removing them from the pending entries of the group."""
+        if len(entry_ids) > 0:
+            self.__db.xack(self.key, group, *entry_ids)
+
+    def trim(self, groups):
+        """Remove the entries that have been acknowledged by all given groups."""
+        min_id = None
+
+        for group in self.__db.xinfo_groups(self.key):
+            name = group['name'].decode('utf-8') if isinstance(group['name'], bytes) else group['name']
+
+            if name not in groups:
+                continue
+
+            pending = self.__db.xpending(self.key, name)
+            group_min_id = pending['min'] if pending['pending'] > 0 else group['last-delivered-id']
+
+            if min_id is None or parse_stream_id(group_min_id) < parse_stream_id(min_id):
+                min_id = group_min_id
+
+        if min_id is not None:
+            self.__db.execute_command('XTRIM', self.key, 'MINID', min_id)
+
+    def qsize(self):
+        """Return the number of entries in the stream."""
+        return self.__db.xlen(self.key)
@@ -0,0 +1,68 @@
+import logging
+import threading
+import time
+from typing import List
+
+from read_handler_interface import ReadHandlerInterface
+from reader import Reader
+from telegram_capture import get_capture_files, read_capture
+
+
+class ReplayReader(Reader):
+    """Feeds captured telegrams through the read handlers instead of reading the serial port.
+
+    A speed of 1 replays in real time, N replays N times faster and 0 as fast as possible. Readings get the time the
+    telegram was received, so a replayed day produces the readings of that day. Solar data is not captured, so
+    replayed readings have no solar."""
+
+    def __init__(self, config: dict, stop_event: threading.Event, logger: logging.Logger,
+                 read_handlers: List[ReadHandlerInterface]):
+        replay_config = config['replay']
+        meter = None
+
+        if replay_config.get('meter_id') is not None:
+            meter = {'id': replay_config['meter_id'], 'dsmr_version': replay_config.get('dsmr_version', '4')}
+
+        # Never capture the telegrams that are being replayed
+        super().__init__(config=dict(config, capture=None), stop_event=stop_event, logger=logger,
+                         read_handlers=read_handlers, meter=meter)
+
+        self.solar_poller = None
+        self.files = get_capture_files(replay_config.get('file', 'telegrams.capture.gz'),
+                                       replay_config.get('backup_count', 5))
+        self.speed = replay_config.get('speed', 1)
+        self.first_received = None
+        self.replay_started = None
+
+    def run(self):
+        self.logger.info(f'Replaying {len(self.files)} capture file(s) at speed {self.speed}')
+        self.read()
+
+        # Keep running until the application stops, so the sinks can deliver the replayed readings
+        self.stop_event.wait()
+
+    def read_telegrams(self):
+        for received, telegram in self.replay():
+            delay = self.get_delay(received)
+
+            if delay > 0 and self.stop_event.wait(delay):
+                return
+
+            yield received, telegram
+
+        self.logger.info('Replay has finished')
+
+    def replay(self):
+        for file_name in self.files:
+            yield from read_capture(file_name)
+
+    def get_delay(self, received: float) -> float:
+        """Return how long to wait before the telegram received at the given time is due."""
+        if self.speed <= 0:
+            return 0
+
+        if self.first_received is None:
+            self.first_received = received
+            self.replay_started = time.time()
+
+        return (received - self.first_received) / self.speed - (time.time() - self.replay_started)
@@ -0,0 +1,212 @@
+import copy
+import logging
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import parse_qs, urlparse
+
+import requests
+from requests.adapters import HTTPAdapter
+
+INVERTER_URL = '/solar_api/v1/GetInverterRealtimeData.cgi?Scope=Device&DeviceId={}&DataCollection=CommonInverterData'
+SYSTEM_URL = '/solar_api/v1/GetInverterRealtimeData.cgi?Scope=System'
+
+# Values that add up over inverters, the voltages are averaged instead
+SUMMED_KEYS = ('pac', 'dayEnergy', 'yearEnergy', 'totalEnergy', 'idc', 'iac')
+AVERAGED_KEYS = ('udc', 'uac')
+# Values that only hold while an inverter responds, unlike its energy counters
+INSTANTANEOUS_KEYS = ('pac', 'udc', 'uac', 'idc', 'iac')
+
+
+class SolarPoller(threading.Thread):
+    """Polls the solar inverters in the background and keeps the latest sample in memory.
+
+    By default the single inverter of solar_url is polled. solar_inverters takes a list of device ids, which are
+    polled concurrently over one keep-alive session, or "system" to read all inverters with one request. With more
+    than one inverter the sample holds the totals, and the sample of every inverter under 'inverters'."""
+
+    def __init__(self, config: dict, stop_event: threading.Event, logger: logging.Logger):
+        super().__init__()
+
+        self.daemon = True
+        self.logger: logging.Logger = logger
+        self.stop_event = stop_event
+
+        self.solar_ip = config['solar_ip']
+        self.poll_interval = config.get('solar_poll_interval', 5)
+        self.max_age = config.get('solar_max_age', 30)
+        self.timeout = config.get('solar_timeout', 2)
+
+        inverters = config.get('solar_inverters')
+        self.system_scope = inverters == 'system'
+
+        if self.system_scope:
+            self.inverter_urls = {'system': self.solar_ip + SYSTEM_URL}
+        elif inverters:
+            self.inverter_urls = {str(inverter): self.solar_ip + INVERTER_URL.format(inverter)
+                                  for inverter in inverters}
+        else:
+            device_id = parse_qs(urlparse(config['solar_url']).query).get('DeviceId', ['1'])[0]
+            self.inverter_urls = {device_id: self.solar_ip + config['solar_url']}
+
+        self.session = requests.Session()
+        self.session.mount('http://', HTTPAdapter(pool_connections=1, pool_maxsize=len(self.inverter_urls)))
+        self.session.mount('https://', HTTPAdapter(pool_connections=1, pool_maxsize=len(self.inverter_urls)))
+        self.executor = ThreadPoolExecutor(max_workers=len(self.inverter_urls), thread_name_prefix='solar-poll')
+
+        self.lock = threading.Lock()
+        self.latest = self.empty_sample()
+        self.last_updated = 0
+        # Latest (sample, time) of every inverter, so one inverter that does not respond does not hide the others
+        self.inverter_samples = {}
+        self.started = False
+
+    @staticmethod
+    def empty_sample() -> dict:
+        return {
+            'pac': 0,
+            'dayEnergy': 0,
+            'yearEnergy': 0,
+            'totalEnergy': 0,
+            'udc': 0,
+            'uac': 0,
+            'idc': 0,
+            'iac': 0,
+        }
+
+    @property
+    def enabled(self) -> bool:
+        return str(self.solar_ip) != ""
+
+    def is_stale(self) -> bool:
+        return time.time() - self.last_updated > self.max_age
+
+    def get_solar(self) -> dict:
+        """Return a copy of the latest sample, or an empty sample when the latest one is stale."""
+        with self.lock:
+            if self.is_stale():
+                return self.empty_sample()
+
+            return copy.copy(self.latest)
+
+    def start(self):
+        # A poller can be shared by several readers, only the first one starts it
+        with self.lock:
+            if self.started:
+                return
+
+            self.started = True
+
+        super().start()
+
+    def run(self):
+        if not self.enabled:
+            return
+
+        self.logger.info('Solar poller has been started')
+
+        while not self.stop_event.is_set():
+            self.poll()
+            self.stop_event.wait(self.poll_interval)
+
+        self.executor.shutdown(wait=False)
+        self.logger.info('Solar poller has been stopped')
+
+    def poll(self):
+        """Poll all inverters concurrently, a poll takes as long as the slowest inverter."""
+        now = time.time()
+
+        if self.system_scope:
+            samples = self.read_system()
+        else:
+            futures = {name: self.executor.submit(self.read_solar, url) for name, url in self.inverter_urls.items()}
+            samples = {name: future.result() for name, future in futures.items()}
+
+        for name, sample in (samples or {}).items():
+            if sample is not None:
+                self.inverter_samples[name] = (sample, now)
+
+        if all(now - updated > self.max_age for _, updated in self.inverter_samples.values()):
+            return
+
+        # An inverter that stopped responding, e.g. at dusk, keeps adding its last known energy counters so the totals
+        # do not drop, only its power is no longer counted
+        samples = {}
+
+        for name, (sample, updated) in self.inverter_samples.items():
+            if now - updated > self.max_age:
+                sample = dict(sample, **{key: 0 for key in INSTANTANEOUS_KEYS})
+
+            samples[name] = sample
+
+        with self.lock:
+            self.latest = self.aggregate(samples)
+            self.last_updated = max(updated for _, updated in self.inverter_samples.values())
+
+    def aggregate(self, samples: dict) -> dict:
+        if len(self.inverter_urls) == 1 and not self.system_scope:
+            return next(iter(samples.values()))
+
+        solar = self.empty_sample()
+
+        for key in SUMMED_KEYS:
+            solar[key] = sum(sample[key] for sample in samples.values())
+
+        for key in AVERAGED_KEYS:
+            values = [sample[key] for sample in samples.values() if sample[key]]
+            solar[key] = sum(values) / len(values) if len(values) > 0 else 0
+
+        solar['inverters'] = samples
+
+        return solar
+
+    def read_system(self, retry=False) -> dict or None:
+        url = self.inverter_urls['system']
+
+        try:
+            solar_data = self.session.get(url=url, timeout=self.timeout).json()['Body']['Data']
+            samples = {}
+
+            # The system scope reports the values of every inverter by device id
+            for key, field in (('pac', 'PAC'), ('dayEnergy', 'DAY_ENERGY'), ('yearEnergy', 'YEAR_ENERGY'),
+                               ('totalEnergy', 'TOTAL_ENERGY')):
+                for inverter, value in solar_data.get(field, {}).get('Values', {}).items():
+                    samples.setdefault(inverter, self.empty_sample())[key] = value or 0
+
+            return samples
+        except requests.exceptions.ConnectTimeout:
+            return None
+        except Exception as e:
+            if not retry:
+                return self.read_system(True)
+
+            self.logger.error('Could not read data from solar api: {}'.format(url), exc_info=e)
+            return None
+
+    def read_solar(self, url, retry=False) -> dict or None:
+        solar = self.empty_sample()
+
+        try:
+            solar_data = self.session.get(url=url, timeout=self.timeout).json()['Body']['Data']
+            solar['dayEnergy'] = solar_data['DAY_ENERGY']['Value']
+            solar['yearEnergy'] = solar_data['YEAR_ENERGY']['Value']
+            solar['totalEnergy'] = solar_data['TOTAL_ENERGY']['Value']
+
+            if 'PAC' not in solar_data:
+                return solar
+
+            solar['pac'] = solar_data['PAC']['Value']
+            solar['udc'] = solar_data['UDC']['Value']
+            solar['uac'] = solar_data['UAC']['Value']
+            solar['idc'] = solar_data['IDC']['Value']
+            solar['iac'] = solar_data['IAC']['Value']
+
+            return solar
+        except requests.exceptions.ConnectTimeout:
+            return None
+        except Exception as e:
+            if not retry:
+                return self.read_solar(url, True)
+
+            self.logger.error('Could not read data from solar api: {}'.format(url), exc_info=e)
+            return None
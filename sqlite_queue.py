@@ -0,0 +1,233 @@
+import contextlib
+import sqlite3
+import threading
+import time
+
+_spool_file = 'energy_reader_spool.db'
+_spools = {}
+_spools_lock = threading.Lock()
+
+
+def set_spool_file(file_name):
+    """Set the database file used by queues that are not given a file of their own."""
+    global _spool_file
+    _spool_file = file_name
+
+
+def get_spool(file_name=None):
+    """Return the process-wide spool for the given database file."""
+    file_name = file_name or _spool_file
+
+    with _spools_lock:
+        if file_name not in _spools:
+            _spools[file_name] = SqliteSpool(file_name)
+
+        return _spools[file_name]
+
+
+class SqliteSpool(object):
+    """Append-only spool of queue items in a SQLite database in WAL mode.
+
+    All queues of the process share one connection. The condition wakes up blocking readers when items are added."""
+    def __init__(self, file_name):
+        self.connection = sqlite3.connect(file_name, check_same_thread=False, isolation_level=None)
+        self.lock = threading.RLock()
+        self.condition = threading.Condition(self.lock)
+
+        with self.lock:
+            self.connection.execute('PRAGMA journal_mode=WAL')
+            self.connection.execute('PRAGMA synchronous=NORMAL')
+            self.connection.execute('CREATE TABLE IF NOT EXISTS items (id INTEGER PRIMARY KEY, queue TEXT NOT NULL, '
+                                    'item BLOB NOT NULL)')
+            self.connection.execute('CREATE INDEX IF NOT EXISTS items_queue ON items (queue, id)')
+            self.connection.execute('CREATE TABLE IF NOT EXISTS key_values (namespace TEXT NOT NULL, '
+                                    'key TEXT NOT NULL, value TEXT NOT NULL, PRIMARY KEY (namespace, key))')
+
+    @contextlib.contextmanager
+    def transaction(self):
+        """Run the statements of the block in a single transaction, the connection is in autocommit mode otherwise."""
+        with self.lock:
+            self.connection.execute('BEGIN IMMEDIATE')
+
+            try:
+                yield
+            except BaseException:
+                self.connection.execute('ROLLBACK')
+                raise
+
+            self.connection.execute('COMMIT')
+
+    def put_many(self, entries):
+        """Append (queue, item) entries in a single transaction."""
+        with self.condition:
+            with self.transaction():
+                self.connection.executemany('INSERT INTO items (queue, item) VALUES (?, ?)',
+                                            [(queue, to_bytes(item)) for queue, item in entries])
+
+            self.condition.notify_all()
+
+    def put_many_front(self, queue, items):
+        """Insert items before every item in the spool, preserving their order."""
+        if len(items) == 0:
+            return
+
+        with self.condition:
+            with self.transaction():
+                first_id = self.connection.execute('SELECT COALESCE(MIN(id), 1) FROM items').fetchone()[0] - len(items)
+                self.connection.executemany('INSERT INTO items (id, queue, item) VALUES (?, ?, ?)',
+                                            [(first_id + i, queue, to_bytes(item)) for i, item in enumerate(items)])
+
+            self.condition.notify_all()
+
+    def get_many(self, queue, n):
+        """Remove and return up to n items from the head of the queue."""
+        if n <= 0:
+            return []
+
+        with self.lock:
+            with self.transaction():
+                rows = self.connection.execute('SELECT id, item FROM items WHERE queue = ? ORDER BY id LIMIT ?',
+                                               (queue, n)).fetchall()
+
+                if len(rows) > 0:
+                    self.connection.execute('DELETE FROM items WHERE queue = ? AND id <= ?', (queue, rows[-1][0]))
+
+        return [bytes(row[1]) for row in rows]
+
+    def peek_many(self, queue, n):
+        """Return up to n items from the head of the queue without removing them."""
+        if n <= 0:
+            return []
+
+        with self.lock:
+            rows = self.connection.execute('SELECT item FROM items WHERE queue = ? ORDER BY id LIMIT ?',
+                                           (queue, n)).fetchall()
+
+        return [bytes(row[0]) for row in rows]
+
+    def replace_head(self, queue, old_items, new_items) -> bool:
+        """Replace old_items at the head of the queue by new_items in a single transaction, preserving their order.
+
+        Returns False, leaving the queue untouched, when the head of the queue no longer holds old_items."""
+        if len(old_items) == 0:
+            return True
+
+        with self.condition:
+            with self.transaction():
+                rows = self.connection.execute('SELECT id, item FROM items WHERE queue = ? ORDER BY id LIMIT ?',
+                                               (queue, len(old_items))).fetchall()
+
+                if [bytes(row[1]) for row in rows] != [to_bytes(item) for item in old_items]:
+                    return False
+
+                self.connection.execute('DELETE FROM items WHERE queue = ? AND id <= ?', (queue, rows[-1][0]))
+
+                if len(new_items) > 0:
+                    min_id = self.connection.execute('SELECT COALESCE(MIN(id), 1) FROM items').fetchone()[0]
+                    first_id = min_id - len(new_items)
+                    self.connection.executemany('INSERT INTO items (id, queue, item) VALUES (?, ?, ?)',
+                                                [(first_id + i, queue, to_bytes(item))
+                                                 for i, item in enumerate(new_items)])
+
+            self.condition.notify_all()
+
+        return True
+
+    def wait(self, queue, timeout=None):
+        """Block until the queue is not empty or the timeout expires. Returns False on timeout."""
+        deadline = None if timeout is None else time.time() + timeout
+
+        with self.condition:
+            while self.qsize(queue) == 0:
+                remaining = None if deadline is None else deadline - time.time()
+
+                if remaining is not None and remaining <= 0:
+                    return False
+
+                self.condition.wait(remaining)
+
+        return True
+
+    def qsize(self, queue):
+        with self.lock:
+            return self.connection.execute('SELECT COUNT(*) FROM items WHERE queue = ?', (queue,)).fetchone()[0]
+
+    def get_values(self, namespace) -> dict:
+        with self.lock:
+            rows = self.connection.execute('SELECT key, value FROM key_values WHERE namespace = ?',
+                                           (namespace,)).fetchall()
+
+        return {key: value for key, value in rows}
+
+    def set_values(self, namespace, values: dict):
+        with self.lock:
+            with self.transaction():
+                self.connection.executemany('INSERT OR REPLACE INTO key_values (namespace, key, value) '
+                                            'VALUES (?, ?, ?)',
+                                            [(namespace, key, str(value)) for key, value in values.items()])
+
+
+def to_bytes(item) -> bytes:
+    if isinstance(item, bytes):
+        return item
+
+    return str(item).encode('utf-8')
+
+
+class SqliteQueue(object):
+    """Queue with a SQLite spool backend, a drop-in replacement for RedisQueue that needs no Redis server."""
+    def __init__(self, name, namespace='queue', file_name=None):
+        self.spool = get_spool(file_name)
+        self.key = '%s:%s' % (namespace, name)
+
+    def qsize(self):
+        """Return the size of the queue."""
+        return self.spool.qsize(self.key)
+
+    def empty(self):
+        """Return True if the queue is empty, False otherwise."""
+        return self.qsize() == 0
+
+    def put(self, item):
+        """Put item into the queue."""
+        self.spool.put_many([(self.key, item)])
+
+    def put_many(self, items):
+        """Put items into the queue in a single transaction."""
+        self.spool.put_many([(self.key, item) for item in items])
+
+    def put_many_front(self, items):
+        """Put items back at the head of the queue in a single transaction, preserving their order."""
+        self.spool.put_many_front(self.key, items)
+
+    def get(self, block=True, timeout=None):
+        """Remove and return an item from the queue.
+
+        If optional args block is true and timeout is None (the default), block
+        if necessary until an item is available."""
+        while True:
+            items = self.spool.get_many(self.key, 1)
+
+            if len(items) > 0:
+                return items[0]
+
+            if not block or not self.spool.wait(self.key, timeout):
+                return None
+
+    def get_nowait(self):
+        """Equivalent to get(False)."""
+        return self.get(False)
+
+    def get_many(self, n):
+        """Remove and return up to n items from the head of the queue in a single transaction."""
+        return self.spool.get_many(self.key, n)
+
+    def peek_many(self, n):
+        """Return up to n items from the head of the queue without removing them."""
+        return self.spool.peek_many(self.key, n)
+
+    def replace_head(self, old_items, new_items) -> bool:
+        """Replace old_items, read from the head of the queue with peek_many, by new_items in a single transaction.
+
+        Returns False, leaving the queue untouched, when a consumer took items from the head in the meantime."""
+        return self.spool.replace_head(self.key, old_items, new_items)
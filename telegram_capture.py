@@ -0,0 +1,83 @@
+import gzip
+import os
+import struct
+import time
+
+# Every record is the receive time, the length of the telegram and the raw telegram itself
+RECORD_HEADER = struct.Struct('<dI')
+
+
+class TelegramCapture(object):
+    """Appends raw telegrams with their receive time to a gzip compressed file.
+
+    The file is rotated when it grows beyond max_bytes, keeping backup_count old files like the rotating log does.
+    Compressed data is flushed every flush_interval seconds, so a crash loses at most that much of the capture."""
+
+    def __init__(self, file_name, max_bytes=10485760, backup_count=5, flush_interval=60):
+        self.file_name = file_name
+        self.max_bytes = max_bytes
+        self.backup_count = backup_count
+        self.flush_interval = flush_interval
+        self.file = None
+        self.last_flush = time.time()
+
+    def write(self, telegram: str, received: float = None):
+        if self.file is None:
+            self.file = gzip.open(self.file_name, 'ab', compresslevel=6)
+
+        data = telegram.encode('ascii')
+        self.file.write(RECORD_HEADER.pack(received or time.time(), len(data)))
+        self.file.write(data)
+
+        if time.time() - self.last_flush >= self.flush_interval:
+            self.last_flush = time.time()
+            self.file.flush()
+
+            if self.file.fileobj.tell() >= self.max_bytes:
+                self.rotate()
+
+    def rotate(self):
+        self.close()
+
+        for index in range(self.backup_count - 1, 0, -1):
+            if os.path.exists(f'{self.file_name}.{index}'):
+                os.replace(f'{self.file_name}.{index}', f'{self.file_name}.{index + 1}')
+
+        if self.backup_count > 0:
+            os.replace(self.file_name, f'{self.file_name}.1')
+        else:
+            os.remove(self.file_name)
+
+    def close(self):
+        if self.file is not None:
+            self.file.close()
+            self.file = None
+
+
+def read_capture(file_name):
+    """Yield the (receive time, telegram) records of a capture file, oldest first."""
+    with gzip.open(file_name, 'rb') as capture_file:
+        while True:
+            try:
+                header = capture_file.read(RECORD_HEADER.size)
+
+                if len(header) < RECORD_HEADER.size:
+                    return
+
+                received, length = RECORD_HEADER.unpack(header)
+                data = capture_file.read(length)
+            except EOFError:
+                # The file is still being written, or the process stopped before closing it
+                return
+
+            if len(data) < length:
+                return
+
+            yield received, data.decode('ascii')
+
+
+def get_capture_files(file_name, backup_count) -> list:
+    """Return the existing files of a rotated capture, oldest first."""
+    file_names = [f'{file_name}.{index}' for index in range(backup_count, 0, -1)] + [file_name]
+
+    return [name for name in file_names if os.path.exists(name)]